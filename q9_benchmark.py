@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Q9 輸入法無頭基準測試
+
+在 QT_QPA_PLATFORM=offscreen 下用錄製或合成的按鍵序列驅動
+Q9InputMethodUI.handle_key_input，輸出使用空後端，不抓取鍵盤。
+報告每個場景的 keys/s、每次提交的耗時分佈 (p50/p95/p99) 和每鍵內存分配。
+
+    python q9_benchmark.py                      # 合成字典 + 合成序列
+    python q9_benchmark.py --root /path/to/q9   # 使用該目錄下的 files/dataset.db 和 files/img
+    python q9_benchmark.py --replay keys.txt    # 回放錄製的按鍵 (數字和 '.'，其他字符忽略)
+    python q9_benchmark.py --compiled           # 使用編譯字典 (files/dataset.q9d)
+    python q9_benchmark.py --key-gap-ms 0       # 按鍵之間不留空閒 (後台預取來不及完成)
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+# 不讀寫用戶的選字頻率記錄，候選順序保持固定
+os.environ.setdefault("Q9_ADAPTIVE", "0")
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtGui import QImage, QColor
+
+import q9_dictionary
+import q9_pyqt_gpt as q9
+
+
+class NullOutputBackend(q9.ClipboardOutputBackend):
+    """不接觸剪貼板和鍵盤，只記錄注入的文字"""
+    name = "null"
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.injected = []
+
+    def inject(self, text):
+        self.injected.append(text)
+
+
+def build_fixture(root, seed=1):
+    """生成合成字典 (mapped_table / related_candidates_table / ts_chinese_table) 和九宮格圖像"""
+    rng = random.Random(seed)
+    img_dir = os.path.join(root, "files", "img")
+    os.makedirs(img_dir, exist_ok=True)
+    for type_val in range(11):
+        for i in range(1, 10):
+            image = QImage(120, 120, QImage.Format_ARGB32)
+            image.fill(QColor(type_val * 20, i * 25, 128))
+            image.save(os.path.join(img_dir, f"{type_val}_{i}.png"))
+
+    chars = [chr(c) for c in range(0x4E00, 0x4E00 + 4000)]
+    codes = [f"{a}{b}{c}" for a in range(1, 10) for b in range(1, 10) for c in range(1, 10)]
+    codes += [str(n) for n in range(0, 100, 10)]
+    db = sqlite3.connect(os.path.join(root, "files", "dataset.db"))
+    db.execute("CREATE TABLE mapped_table (id TEXT, characters TEXT)")
+    db.execute("CREATE TABLE related_candidates_table (character TEXT, candidates TEXT)")
+    db.execute("CREATE TABLE ts_chinese_table (traditional TEXT, simplified TEXT)")
+    db.executemany("INSERT INTO mapped_table VALUES (?, ?)",
+                   [(code, "".join(rng.sample(chars, rng.randint(5, 60)))) for code in codes])
+    db.executemany("INSERT INTO related_candidates_table VALUES (?, ?)",
+                   [(ch, " ".join(rng.choice(chars) + rng.choice(chars) for _ in range(rng.randint(3, 30))))
+                    for ch in chars[:3000]])
+    db.executemany("INSERT INTO ts_chinese_table VALUES (?, ?)",
+                   [(ch, chr(ord(ch) + 0x1000)) for ch in chars[:1500]])
+    db.commit()
+    db.close()
+    q9_dictionary.ensure_indexes(os.path.join(root, "files", "dataset.db"))
+
+
+def code_keys(code):
+    return list(code)
+
+
+def synthetic_streams(index, rng, commits):
+    """按場景生成按鍵序列: 每個元素是一次提交所需的按鍵"""
+    codes = sorted(index.codes)
+    selection, paging, relate = [], [], []
+    for _ in range(commits):
+        code = rng.choice(codes)
+        chars = index.codes[code]
+        pos = rng.randrange(min(len(chars), 9))
+        selection.append(code_keys(code) + [str(pos + 1)])
+
+        code = rng.choice(codes)
+        chars = index.codes[code]
+        pos = rng.randrange(len(chars))
+        paging.append(code_keys(code) + ["0"] * (pos // 9) + [str(pos % 9 + 1)])
+
+    with_relates = [(code, pos) for code in codes for pos, ch in enumerate(index.codes[code][:9])
+                    if index.relates.get(ch)]
+    for _ in range(commits if with_relates else 0):
+        code, pos = rng.choice(with_relates)
+        relates = index.lookup_relates(index.codes[code][pos])
+        pick = rng.randrange(min(len(relates), 9))
+        # 選字 → 關聯詞預覽 → 0 進入選詞 → 選詞
+        relate.append(code_keys(code) + [str(pos + 1), "0", str(pick + 1)])
+    return {"selection": selection, "paging": paging, "relate": relate}
+
+
+def replay_stream(path):
+    with open(path, encoding="utf-8") as f:
+        keys = [ch for ch in f.read() if ch.isdigit() or ch == "."]
+    # 回放序列沒有提交邊界，整段作為一組
+    return {"replay": [keys]}
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return q9.LatencyTracer.percentile(values, pct) if values else 0
+
+
+def idle(app, seconds):
+    """模擬按鍵間隔: 處理事件並讓出 CPU 給後台預取 (不計時)"""
+    end = time.perf_counter() + seconds
+    while True:
+        app.processEvents()
+        remaining = end - time.perf_counter()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, 0.001))
+
+
+def run_scenario(app, ui, groups, measure_alloc, key_gap=0.0):
+    """返回 (按鍵數, 總耗時 s, 每次提交耗時列表 ns, 分配塊數, 分配字節)
+
+    key_gap: 每個按鍵之後的空閒時間 (s)，不計入耗時
+    """
+    ui.reset_input()
+    commit_ns = []
+    keys = 0
+    total_ns = 0
+    if measure_alloc:
+        tracemalloc.start()
+        snapshot_before = tracemalloc.take_snapshot()
+    for group in groups:
+        group_ns = 0
+        for key in group:
+            start = time.perf_counter_ns()
+            ui.handle_key_input(key)
+            group_ns += time.perf_counter_ns() - start
+            keys += 1
+            if key_gap:
+                idle(app, key_gap)
+        # 讓排隊的輸出和重繪在每組之後完成 (提交緩衝不等合併窗口，立即注入)
+        start = time.perf_counter_ns()
+        app.processEvents()
+        ui.flush_output()
+        group_ns += time.perf_counter_ns() - start
+        total_ns += group_ns
+        commit_ns.append(group_ns)
+    blocks = size = 0
+    if measure_alloc:
+        stats = tracemalloc.take_snapshot().compare_to(snapshot_before, "filename")
+        tracemalloc.stop()
+        blocks = sum(stat.count_diff for stat in stats if stat.count_diff > 0)
+        size = sum(stat.size_diff for stat in stats if stat.size_diff > 0)
+    return keys, total_ns / 1e9, commit_ns, blocks, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Q9 輸入法無頭基準測試")
+    parser.add_argument("--root", help="包含 files/dataset.db 和 files/img 的目錄 (默認生成合成字典)")
+    parser.add_argument("--replay", help="錄製的按鍵序列文件")
+    parser.add_argument("--commits", type=int, default=300, help="每個合成場景的提交次數")
+    parser.add_argument("--repeat", type=int, default=3, help="計時重複次數 (取最好的一次)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--key-gap-ms", type=float, default=2.0,
+                        help="按鍵之間的空閒時間 (不計時，後台預取在此期間完成；0 表示連續輸入)")
+    parser.add_argument("--compiled", action="store_true", help="先編譯字典 (q9_dictionary)，測試 mmap 查詢路徑")
+    parser.add_argument("--log-level", default="WARNING", help="應用日誌級別 (默認 WARNING，不計入基準)")
+    args = parser.parse_args()
+    q9.setup_logging(args.log_level)
+
+    app = QApplication(sys.argv[:1])
+    tmp = tempfile.TemporaryDirectory(prefix="q9bench-")
+    # 圖集寫在臨時目錄裡，隨臨時目錄一起刪除，不留在用戶的 ~/.cache/q9
+    os.environ.setdefault("Q9_CACHE_DIR", os.path.join(tmp.name, "cache"))
+    root = args.root
+    if root is None:
+        root = tmp.name
+        build_fixture(root, args.seed)
+    os.chdir(root)
+    if args.compiled:
+        q9_dictionary.compile_dictionary(os.path.join("files", "dataset.db"))
+
+    ui = q9.Q9InputMethodUI(None, start_hook=False)
+    ui.output_backend = NullOutputBackend(app)
+    ui.show()
+    app.processEvents()
+    if ui.code_index:
+        ui.code_index.wait()
+    if args.replay:
+        scenarios = replay_stream(args.replay)
+    elif ui.code_index and ui.code_index.codes:
+        scenarios = synthetic_streams(ui.code_index, random.Random(args.seed), args.commits)
+    else:
+        print("沒有可用的字典，請指定 --root 或 --replay", file=sys.stderr)
+        return 1
+
+    key_gap = args.key_gap_ms / 1000
+    results = {}
+    for name, groups in scenarios.items():
+        if not groups:
+            continue
+        run_scenario(app, ui, groups, False, key_gap)  # 預熱緩存
+        best = min((run_scenario(app, ui, groups, False, key_gap) for _ in range(args.repeat)),
+                   key=lambda r: r[1])
+        _, _, _, blocks, size = run_scenario(app, ui, groups, True, key_gap)
+        results[name] = best[:3] + (blocks, size)
+
+    compiled = ui.code_index.compiled if ui.code_index else None
+    print(f"字典: {os.path.join(root, compiled.path if compiled else ui.db_path)}")
+    print(f"{'scenario':<10}{'keys':>7}{'keys/s':>10}{'commit p50 ms':>15}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'alloc blk/key':>15}{'alloc B/key':>13}")
+    for name, (keys, seconds, commit_ns, blocks, size) in results.items():
+        print(f"{name:<10}{keys:>7}{keys / seconds:>10.0f}"
+              f"{percentile(commit_ns, 50) / 1e6:>15.3f}{percentile(commit_ns, 95) / 1e6:>9.3f}"
+              f"{percentile(commit_ns, 99) / 1e6:>9.3f}{blocks / keys:>15.1f}{size / keys:>13.0f}")
+    prefetcher = ui.prefetcher
+    print(ui.image_memory_report())
+    print(f"候選預取命中率: {prefetcher.hit_rate():.1%} ({prefetcher.hits}/{prefetcher.hits + prefetcher.misses})")
+    ui.close()
+    tmp.cleanup()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
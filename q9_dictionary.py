@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Q9 編譯字典: 給 files/dataset.db 補建查詢索引，並把它編譯成一個可 mmap 的二進制文件
+
+啟動時直接 mmap 編譯字典，不打開 SQLite；多個輸入法實例共用同一份頁緩存。
+源數據庫的大小或修改時間與編譯時不同 (或文件缺失/版本不符) 時，輸入法回退到 dataset.db，
+此時 (載入內存索引完成前的) 點查詢使用這裡建立的覆蓋索引。輸入法本身不寫 dataset.db。
+
+文件格式 (小端):
+    文件頭   magic "Q9DICT\\0\\0"、版本、源文件大小和修改時間 (ns)、
+             三個表 (codes / relates / ts) 的 (記錄偏移, 條數)、字串池 (偏移, 長度)
+    記錄     每表按鍵的 UTF-8 字節排序的定長記錄 (鍵偏移, 鍵長, 值偏移, 值長)，偏移相對字串池
+    字串池   所有鍵和值的 UTF-8 字節
+
+    python q9_dictionary.py                                  # files/dataset.db → files/dataset.q9d
+    python q9_dictionary.py --db other.db --output other.q9d
+"""
+import argparse
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import time
+import urllib.parse
+from collections.abc import Mapping
+
+log = logging.getLogger("q9.db")
+
+FORMAT_VERSION = 1
+MAGIC = b"Q9DICT\0\0"
+TABLES = ("codes", "relates", "ts")
+HEADER = struct.Struct("<8sIIQQ" + "QI" * len(TABLES) + "QQ")
+RECORD = struct.Struct("<IIII")
+
+# 與 q9_pyqt_gpt 的內存索引相同的取值規則: 空值跳過，重複鍵取第一行
+SOURCE_QUERIES = {
+    "codes": "SELECT id, characters FROM mapped_table",
+    "relates": "SELECT character, candidates FROM related_candidates_table",
+    "ts": "SELECT traditional, simplified FROM ts_chinese_table",
+}
+
+
+# (索引名, 表, 列): 查詢列在前，結果列在後，點查詢只讀索引
+INDEXES = (
+    ("q9_mapped_id", "mapped_table", ("id", "characters")),
+    ("q9_related_character", "related_candidates_table", ("character", "candidates")),
+    ("q9_ts_traditional", "ts_chinese_table", ("traditional", "simplified")),
+)
+
+
+def compiled_path(db_path):
+    return os.path.splitext(db_path)[0] + ".q9d"
+
+
+def has_index(conn, table, column):
+    """表上是否已有以 column 開頭的索引 (包括主鍵)"""
+    for row in conn.execute(f'PRAGMA index_list("{table}")'):
+        index_columns = conn.execute(f'PRAGMA index_info("{row[1]}")').fetchall()
+        if index_columns and index_columns[0][2] == column:
+            return True
+    # INTEGER PRIMARY KEY 是 rowid 本身
+    for row in conn.execute(f'PRAGMA table_info("{table}")'):
+        if row[1] == column and row[5] == 1 and row[2].upper() == "INTEGER":
+            return True
+    return False
+
+
+def missing_indexes(conn):
+    return [name for name, table, columns in INDEXES if not has_index(conn, table, columns[0])]
+
+
+def ensure_indexes(db_path):
+    """補建缺少的覆蓋索引，返回新建的索引名 (已齊全時不寫文件)"""
+    conn = sqlite3.connect(db_path, timeout=1.0)
+    try:
+        created = []
+        for name, table, columns in INDEXES:
+            if has_index(conn, table, columns[0]):
+                continue
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({", ".join(columns)})')
+            conn.commit()
+            created.append(name)
+        return created
+    finally:
+        conn.close()
+
+
+def read_source(db_path):
+    """從 dataset.db 讀出三個表 (表名 -> {鍵: 值})"""
+    uri = "file:" + urllib.parse.quote(os.path.abspath(db_path)) + "?mode=ro"
+    conn = sqlite3.connect(uri, uri=True)
+    try:
+        tables = {}
+        for name in TABLES:
+            entries = {}
+            for key, value in conn.execute(SOURCE_QUERIES[name]):
+                if key is None or not value:
+                    continue
+                entries.setdefault(str(key), value)
+            tables[name] = entries
+        return tables
+    finally:
+        conn.close()
+
+
+def compile_dictionary(db_path, output_path=None):
+    """編譯 db_path，先寫臨時文件再替換，正在 mmap 舊文件的實例不受影響"""
+    output_path = output_path or compiled_path(db_path)
+    st = os.stat(db_path)
+    tables = read_source(db_path)
+
+    pool = bytearray()
+    offsets = {}
+
+    def intern(text):
+        data = text.encode("utf-8")
+        offset = offsets.get(data)
+        if offset is None:
+            offset = offsets[data] = len(pool)
+            pool.extend(data)
+        return offset, len(data)
+
+    records = []
+    for name in TABLES:
+        encoded = sorted((key.encode("utf-8"), key, value) for key, value in tables[name].items())
+        rows = bytearray()
+        for _, key, value in encoded:
+            rows += RECORD.pack(*intern(key), *intern(value))
+        records.append((rows, len(encoded)))
+
+    table_fields = []
+    position = HEADER.size
+    for rows, count in records:
+        table_fields += [position, count]
+        position += len(rows)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, 0, st.st_size, st.st_mtime_ns,
+                         *table_fields, position, len(pool))
+
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        for rows, _ in records:
+            f.write(rows)
+        f.write(pool)
+    os.replace(tmp_path, output_path)
+    return {name: count for name, (_, count) in zip(TABLES, records)}, position + len(pool)
+
+
+class CompiledTable(Mapping):
+    """編譯字典中的一個表，按需二分查找並解碼，不預先建立 dict"""
+
+    def __init__(self, data, records_offset, count, pool_offset):
+        self._data = data
+        self._records_offset = records_offset
+        self._count = count
+        self._pool_offset = pool_offset
+
+    def _record(self, index):
+        return RECORD.unpack_from(self._data, self._records_offset + index * RECORD.size)
+
+    def _bytes(self, offset, length):
+        start = self._pool_offset + offset
+        return self._data[start:start + length]
+
+    def __getitem__(self, key):
+        target = key.encode("utf-8")
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key_offset, key_length, value_offset, value_length = self._record(mid)
+            probe = self._bytes(key_offset, key_length)
+            if probe < target:
+                lo = mid + 1
+            elif probe > target:
+                hi = mid
+            else:
+                return self._bytes(value_offset, value_length).decode("utf-8")
+        raise KeyError(key)
+
+    def __iter__(self):
+        for index in range(self._count):
+            key_offset, key_length, _, _ = self._record(index)
+            yield self._bytes(key_offset, key_length).decode("utf-8")
+
+    def __len__(self):
+        return self._count
+
+    def items(self):
+        for index in range(self._count):
+            key_offset, key_length, value_offset, value_length = self._record(index)
+            yield (self._bytes(key_offset, key_length).decode("utf-8"),
+                   self._bytes(value_offset, value_length).decode("utf-8"))
+
+
+class CompiledDictionary:
+    """唯讀 mmap 打開的編譯字典"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse_header()
+        except ValueError:
+            self._mmap.close()
+            raise
+
+    def _parse_header(self):
+        size = len(self._mmap)
+        if size < HEADER.size:
+            raise ValueError("文件過短")
+        fields = HEADER.unpack_from(self._mmap, 0)
+        magic, version, _, self.source_size, self.source_mtime_ns = fields[:5]
+        if magic != MAGIC:
+            raise ValueError("不是 Q9 編譯字典")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"版本 {version} 不受支持 (需要 {FORMAT_VERSION})")
+        pool_offset, pool_length = fields[-2:]
+        if pool_offset + pool_length > size:
+            raise ValueError("字串池越界")
+        self.tables = {}
+        for i, name in enumerate(TABLES):
+            records_offset, count = fields[5 + 2 * i], fields[6 + 2 * i]
+            if records_offset + count * RECORD.size > pool_offset:
+                raise ValueError(f"{name} 表越界")
+            self.tables[name] = CompiledTable(self._mmap, records_offset, count, pool_offset)
+
+    def table(self, name):
+        return self.tables[name]
+
+    def matches_source(self, db_path):
+        """源數據庫自編譯後未被修改"""
+        try:
+            st = os.stat(db_path)
+        except OSError:
+            return False
+        return st.st_size == self.source_size and st.st_mtime_ns == self.source_mtime_ns
+
+    def close(self):
+        self.tables = {}
+        self._mmap.close()
+
+
+def open_compiled_dictionary(db_path):
+    """返回與 db_path 一致的編譯字典；缺失、損壞或過期時返回 None (調用方回退到 SQLite)"""
+    path = compiled_path(db_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        dictionary = CompiledDictionary(path)
+    except (OSError, ValueError) as e:
+        log.warning("編譯字典無法使用 (%s): %s", path, e)
+        return None
+    if os.path.exists(db_path) and not dictionary.matches_source(db_path):
+        log.info("編譯字典已過期，使用 %s (重新編譯: python q9_dictionary.py)", db_path)
+        dictionary.close()
+        return None
+    return dictionary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="給 dataset.db 建立查詢索引並編譯成 mmap 字典")
+    parser.add_argument("--db", default="files/dataset.db")
+    parser.add_argument("--output", help="輸出路徑 (默認與 --db 同名，擴展名 .q9d)")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    try:
+        # 先建索引: 它會改變 dataset.db 的修改時間，編譯記錄的是之後的狀態
+        for name in ensure_indexes(args.db):
+            print(f"已建立索引 {name}")
+        counts, size = compile_dictionary(args.db, args.output)
+    except (OSError, sqlite3.Error) as e:
+        print(f"編譯失敗: {e}", file=sys.stderr)
+        return 1
+    print(f"{args.output or compiled_path(args.db)}: {size} 字節, "
+          + ", ".join(f"{name} {count} 條" for name, count in counts.items())
+          + f", {(time.perf_counter() - start) * 1000:.1f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
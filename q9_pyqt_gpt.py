@@ -1,44 +1,166 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import argparse
 import ctypes
+import ctypes.util
 import sys
+import json
+import atexit
+import bisect
+import functools
+import getpass
+import hashlib
+import heapq
+import logging
+import logging.handlers
+import queue
 import sqlite3
 import os
 import threading
 import subprocess
 import platform
+import re
+import selectors
+import shutil
+import signal
+import socket
+import struct
 import time
-from queue import Queue, Empty
+import urllib.parse
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5.QtWidgets import (QApplication, QWidget, QGridLayout, QVBoxLayout,
-                             QPushButton, QLabel, QFrame, QMenu)
-from PyQt5.QtCore import Qt, QSize, QTimer
-from PyQt5.QtGui import QPixmap, QIcon, QPainter, QResizeEvent, QFont, QColor, QPen,QFontDatabase
+                             QPushButton, QLabel, QFrame, QMenu, QInputDialog, QMessageBox)
+from PyQt5.QtCore import Qt, QSize, QRect, QTimer, QObject, QSocketNotifier, QFileSystemWatcher, QStandardPaths, pyqtSignal
+from PyQt5.QtGui import QPixmap, QImage, QImageReader, QIcon, QPainter, QResizeEvent, QFont, QColor, QPen,QFontDatabase
+from PyQt5.QtNetwork import QLocalServer, QLocalSocket
+
+from q9_dictionary import compiled_path, missing_indexes, open_compiled_dictionary
+
+# 分子系統的日誌，級別由 Q9_LOG_LEVEL 控制 (見 setup_logging)
+log = logging.getLogger("q9")
+hook_log = logging.getLogger("q9.hook")
+ui_log = logging.getLogger("q9.ui")
+db_log = logging.getLogger("q9.db")
+image_log = logging.getLogger("q9.image")
+output_log = logging.getLogger("q9.output")
+trace_log = logging.getLogger("q9.trace")
+
+def setup_logging(level=None):
+    """配置 q9 日誌: 記錄先放入隊列，由後台線程寫到 stderr，輸入線程不會因終端/journald 阻塞
+
+    級別取 level 參數或環境變量 Q9_LOG_LEVEL (默認 INFO)。DEBUG 關閉時 log.debug 只做一次級別判斷。
+    """
+    level = (level or os.environ.get("Q9_LOG_LEVEL", "INFO")).upper()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    for old_handler in list(log.handlers):
+        log.removeHandler(old_handler)
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(level)
+    log.propagate = False
+    listener.start()
+    # 退出時把隊列中剩餘的記錄寫完
+    atexit.register(listener.stop)
+    return listener
+
 current_os = platform.system()
-print(f"检测到操作系统: {current_os}")
 
+# 导入时只检测平台模块；结果由 log_platform_support() 在 setup_logging 之后记录
 if current_os == "Linux":
     try:
         from evdev import ecodes, InputDevice, UInput, KeyEvent
         LINUX_EVDEV_AVAILABLE = True
-        print("Linux evdev 模块加载成功")
+        # 只伴随其他事件出现的类型: 帧里只剩这些时不需要转发
+        FRAME_ONLY_EVENT_TYPES = (ecodes.EV_SYN, ecodes.EV_MSC)
     except ImportError:
-        print("警告: Linux 系统但 evdev 模块未安装")
         LINUX_EVDEV_AVAILABLE = False
 elif current_os == "Windows":
     try:
         import pynput
         from pynput import keyboard
         WINDOWS_PYNPUT_AVAILABLE = True
-        print("Windows pynput 模块加载成功")
     except ImportError:
-        print("警告: Windows 系统但 pynput 模块未安装")
-        print("请运行: pip install pynput")
         WINDOWS_PYNPUT_AVAILABLE = False
 else:
-    print(f"不支持的操作系统: {current_os}")
     LINUX_EVDEV_AVAILABLE = False
     WINDOWS_PYNPUT_AVAILABLE = False
 
+def log_platform_support():
+    """记录导入时检测到的平台支持 (模块导入时日志还没配置，INFO 记录会被丢掉)"""
+    log.info("检测到操作系统: %s", current_os)
+    if current_os == "Linux":
+        if LINUX_EVDEV_AVAILABLE:
+            log.info("Linux evdev 模块加载成功")
+        else:
+            log.warning("警告: Linux 系统但 evdev 模块未安装")
+    elif current_os == "Windows":
+        if WINDOWS_PYNPUT_AVAILABLE:
+            log.info("Windows pynput 模块加载成功")
+        else:
+            log.warning("警告: Windows 系统但 pynput 模块未安装")
+            log.warning("请运行: pip install pynput")
+    else:
+        log.warning("不支持的操作系统: %s", current_os)
+
+# 白底主题样式表。尺寸和字体随窗口缩放，由 apply_scale 直接设置，不写在这里
+GRID_BUTTON_PADDING = 2
+FUNCTION_BUTTON_PADDING = 3
+BUTTON_BORDER = 1
+BASE_STYLE_SHEET = f"""
+    QWidget {{
+        background-color: #ffffff;
+        color: #000000;
+    }}
+    QPushButton {{
+        background-color: #f0f0f0;
+        border: {BUTTON_BORDER}px solid #cccccc;
+        border-radius: 3px;
+        color: #000000;
+        padding: {GRID_BUTTON_PADDING}px;
+    }}
+    QPushButton#NumberButton {{
+        background-color: #f8f8f8;
+        border: {BUTTON_BORDER}px solid #cccccc;
+        border-radius: 1px;
+        color: #000000;
+        padding: {GRID_BUTTON_PADDING}px;
+    }}
+    QPushButton:hover {{
+        background-color: #e0e0e0;
+        border-color: #999999;
+    }}
+    QPushButton:pressed {{
+        background-color: #d0d0d0;
+        border-color: #666666;
+    }}
+    QPushButton#relate-preview {{
+        background-color: #f8f8f8;
+        border: {BUTTON_BORDER}px solid #cccccc;
+        border-radius: 3px;
+        color: #333333;
+        text-align: left;
+        padding: {GRID_BUTTON_PADDING}px;
+    }}
+    QPushButton#function-button {{
+        background-color: #e0e0e0;
+        border: {BUTTON_BORDER}px solid #cccccc;
+        border-radius: 3px;
+        color: #000000;
+        padding: {FUNCTION_BUTTON_PADDING}px;
+    }}
+    QLabel {{
+        color: #000000;
+        font-size: 26px;
+        text-align: center;
+        padding: 1px;
+        background-color: transparent;
+    }}
+"""
+
 class CustomGridFrame(QFrame):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -49,19 +171,1291 @@ class CustomGridFrame(QFrame):
         # Trigger the parent's right-click handler
         self.parent().on_grid_right_click(pos)
 
+class KeyEventBridge(QObject):
+    """鉤子線程 → GUI 線程的按鍵投遞通道 (QueuedConnection, 無輪詢)，附帶投遞時間戳
+
+    frame_received: 有待輸出文字時要轉發的事件幀，交給 GUI 線程在注入文字之後寫出。
+    """
+    key_received = pyqtSignal(str, object)
+    frame_received = pyqtSignal(object, object)
+
+class LatencyTracer:
+    """輸入管線各階段耗時 (單調時鐘 ns)，每階段一個環形緩衝，可輸出 p50/p95/p99 和直方圖
+
+    階段: queue (鉤子投遞 → GUI 線程取出), lookup, render, output, total (投遞 → 處理完成)。
+    未啟用時各埋點只做一次布爾判斷。
+    """
+    STAGES = ("queue", "lookup", "render", "output", "total")
+
+    def __init__(self, capacity=4096, enabled=False):
+        self.enabled = enabled
+        self.samples = {stage: deque(maxlen=capacity) for stage in self.STAGES}
+        self.counters = {}
+        self.sections = []  # 附加在報告末尾的其他統計 (返回文字的函數)
+
+    def now(self):
+        return time.perf_counter_ns() if self.enabled else 0
+
+    def record(self, stage, start_ns):
+        self.samples[stage].append(time.perf_counter_ns() - start_ns)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def reset(self):
+        for samples in self.samples.values():
+            samples.clear()
+        self.counters.clear()
+
+    @staticmethod
+    def percentile(sorted_values, pct):
+        index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+        return sorted_values[index]
+
+    def report(self):
+        lines = [f"{'stage':<8}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        histograms = []
+        for stage in self.STAGES:
+            values = sorted(self.samples[stage])
+            if not values:
+                lines.append(f"{stage:<8}{0:>7}")
+                continue
+            p50, p95, p99 = (self.percentile(values, pct) / 1e6 for pct in (50, 95, 99))
+            lines.append(f"{stage:<8}{len(values):>7}{p50:>10.3f}{p95:>10.3f}{p99:>10.3f}{values[-1] / 1e6:>10.3f}")
+            # 以 2 的冪 (µs) 分桶的直方圖
+            buckets = {}
+            for value in values:
+                bucket = max(value // 1000, 1).bit_length() - 1
+                buckets[bucket] = buckets.get(bucket, 0) + 1
+            histograms.append(f"[{stage}]")
+            peak = max(buckets.values())
+            for bucket in sorted(buckets):
+                bar = "#" * max(1, buckets[bucket] * 40 // peak)
+                histograms.append(f"  <{2 ** (bucket + 1):>8} µs {buckets[bucket]:>6} {bar}")
+        counters = [f"{name}: {value}" for name, value in sorted(self.counters.items())]
+        sections = [section() for section in self.sections]
+        return "\n".join(lines + [""] + histograms + [""] + counters + [""] + sections)
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.report() + "\n")
+
+# GUI 線程 (主線程): 只有它上面的調用計入延遲統計
+GUI_THREAD_ID = threading.main_thread().ident
+
+def traced(stage):
+    """把方法耗時記入 self.tracer 的對應階段 (後台線程的預取/預渲染調用不計)"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            tracer = self.tracer
+            if not tracer.enabled or threading.get_ident() != GUI_THREAD_ID:
+                return func(self, *args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                tracer.record(stage, start)
+        return wrapper
+    return decorator
+
+class DatasetDB:
+    """dataset.db 訪問層: 具名參數化查詢、唯讀連接 (每線程一個) 和每條查詢的耗時統計
+
+    輸入法不寫 dataset.db；點查詢用的覆蓋索引由 q9_dictionary 建立 (見 warn_missing_indexes)。
+    """
+    QUERIES = {
+        "code": "SELECT characters FROM mapped_table WHERE id = ? LIMIT 1",
+        "relates": "SELECT candidates FROM related_candidates_table WHERE character = ? LIMIT 1",
+        "ts": "SELECT simplified FROM ts_chinese_table WHERE traditional = ? LIMIT 1",
+        "all_codes": "SELECT id, characters FROM mapped_table",
+        "all_relates": "SELECT character, candidates FROM related_candidates_table",
+        "all_ts": "SELECT traditional, simplified FROM ts_chinese_table",
+    }
+    MMAP_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.stats = {}  # 查詢名 -> [次數, 總耗時 ns, 最大耗時 ns]
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+
+    def connect(self):
+        uri = "file:" + urllib.parse.quote(os.path.abspath(self.path)) + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True)
+        conn.execute(f"PRAGMA mmap_size={self.MMAP_SIZE}")
+        return conn
+
+    def connection(self):
+        """當前線程的唯讀連接 (sqlite 連接不可跨線程共用)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self.connect()
+        return conn
+
+    def close_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def query(self, name, params=()):
+        start = time.perf_counter_ns()
+        try:
+            return self.connection().execute(self.QUERIES[name], params).fetchall()
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            with self._stats_lock:
+                entry = self.stats.setdefault(name, [0, 0, 0])
+                entry[0] += 1
+                entry[1] += elapsed
+                entry[2] = max(entry[2], elapsed)
+
+    def query_value(self, name, params):
+        rows = self.query(name, params)
+        return rows[0][0] if rows else None
+
+    def warn_missing_indexes(self):
+        """缺少覆蓋索引時提示 (載入內存索引前的點查詢會掃表)，只讀檢查"""
+        try:
+            missing = missing_indexes(self.connection())
+        except sqlite3.Error as e:
+            db_log.warning("無法檢查索引: %s", e)
+            return
+        if missing:
+            db_log.info("dataset.db 缺少索引 %s，可運行 python q9_dictionary.py 建立", ", ".join(missing))
+
+    def report(self):
+        with self._stats_lock:
+            stats = sorted(self.stats.items())
+        lines = [f"{'query':<12}{'count':>7}{'total ms':>10}{'avg µs':>10}{'max ms':>10}"]
+        for name, (count, total, longest) in stats:
+            lines.append(f"{name:<12}{count:>7}{total / 1e6:>10.3f}{total / count / 1e3:>10.1f}{longest / 1e6:>10.3f}")
+        return "\n".join(lines)
+
+class BackgroundIndex:
+    """在後台線程從 dataset.db 建立的唯讀內存索引，載入完成前由子類決定直接查庫或等待"""
+    label = "索引"
+
+    def __init__(self, db, compiled=None):
+        self.db = db
+        self.compiled = compiled  # 有編譯字典時不打開 SQLite
+        self.load_seconds = None  # 載入成功後的耗時
+        self.failed = False  # 有表載入出錯 (索引可能不完整)
+        self._ready = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            if self.compiled is not None:
+                self._load_compiled(self.compiled)
+            else:
+                try:
+                    self._build(self.db)
+                finally:
+                    if self.db is not None:
+                        self.db.close_connection()
+            self.load_seconds = time.perf_counter() - start
+            db_log.info("%s載入完成: %.1f ms", self.label, self.load_seconds * 1000)
+        except Exception as e:
+            self.failed = True
+            db_log.error("%s載入失敗: %s", self.label, e)
+        finally:
+            self._ready.set()
+
+    def _build(self, db):
+        raise NotImplementedError
+
+    def _load_compiled(self, compiled):
+        raise NotImplementedError
+
+    def can_query_directly(self):
+        """載入未完成且有 SQLite 可查時返回 True，否則先等待載入完成"""
+        if self.is_ready():
+            return False
+        if self.db is None:
+            self.wait()
+            return False
+        return True
+
+    def wait(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def is_ready(self):
+        return self._ready.is_set()
+
+class CodeIndex(BackgroundIndex):
+    """mapped_table / related_candidates_table 的內存索引 (code → 字串, 字 → 關聯詞)"""
+    label = "編碼索引"
+
+    def __init__(self, db, compiled=None):
+        super().__init__(db, compiled)
+        self.codes = {}
+        self.relates = {}
+
+    def _build(self, db):
+        codes = {}
+        try:
+            for code, chars in db.query("all_codes"):
+                if code is not None and chars:
+                    # 與原來 fetchone() 一致: 重複 id 取第一行
+                    codes.setdefault(str(code), chars)
+        except sqlite3.Error as e:
+            self.failed = True
+            db_log.error("mapped_table 載入錯誤: %s", e)
+        relates = {}
+        try:
+            for word, candidates in db.query("all_relates"):
+                if word and candidates:
+                    relates.setdefault(word, candidates)
+        except sqlite3.Error as e:
+            self.failed = True
+            db_log.error("related_candidates_table 載入錯誤: %s", e)
+        self.codes = codes
+        self.relates = relates
+
+    def _load_compiled(self, compiled):
+        # mmap 表按需二分查找，不建 dict
+        self.codes = compiled.table("codes")
+        self.relates = compiled.table("relates")
+
+    def lookup_code(self, code):
+        if self.can_query_directly():
+            # 載入未完成: 直接走索引點查詢，不等待整表載入
+            chars = self.db.query_value("code", (code,))
+        else:
+            chars = self.codes.get(code)
+        return list(chars) if chars else None
+
+    def lookup_relates(self, word):
+        if self.can_query_directly():
+            candidates = self.db.query_value("relates", (word,))
+        else:
+            candidates = self.relates.get(word)
+        if not candidates:
+            return None
+        return [w.strip() for w in candidates.split(" ") if w.strip()] or None
+
+class TSConverter(BackgroundIndex):
+    """ts_chinese_table 繁→簡轉換: 單字用 str.translate 一次轉整串，多字詞組按首字索引、最長匹配優先"""
+    label = "繁簡轉換表"
+
+    def __init__(self, db, compiled=None):
+        super().__init__(db, compiled)
+        self.char_table = {}
+        self.phrases = {}
+        self.phrase_lengths = {}  # 首字 → 以它開頭的詞組長度 (長的在前)
+
+    def _build(self, db):
+        self._build_tables(db.query("all_ts"))
+
+    def _load_compiled(self, compiled):
+        self._build_tables(compiled.table("ts").items())
+
+    def _build_tables(self, rows):
+        char_table = {}
+        phrases = {}
+        for traditional, simplified in rows:
+            if not traditional or not simplified:
+                continue
+            # 與原來 LIMIT 1 一致: 重複的繁體取第一行
+            if len(traditional) == 1:
+                char_table.setdefault(ord(traditional), simplified)
+            else:
+                phrases.setdefault(traditional, simplified)
+        phrase_lengths = {}
+        for phrase in phrases:
+            phrase_lengths.setdefault(phrase[0], set()).add(len(phrase))
+        self.char_table = char_table
+        self.phrases = phrases
+        self.phrase_lengths = {char: sorted(lengths, reverse=True) for char, lengths in phrase_lengths.items()}
+
+    def convert(self, text):
+        if self.can_query_directly():
+            # 載入未完成: 逐字點查詢 (詞組映射要等載入完成)
+            return "".join(self.db.query_value("ts", (char,)) or char for char in text)
+        phrase_lengths = self.phrase_lengths
+        if phrase_lengths.keys().isdisjoint(text):
+            # 沒有詞組首字 (大多數輸出) 時只需一次 translate
+            return text.translate(self.char_table)
+        phrases = self.phrases
+        parts = []
+        start = pos = 0
+        while pos < len(text):
+            for length in phrase_lengths.get(text[pos], ()):
+                phrase = text[pos:pos + length]
+                if phrase in phrases:
+                    parts.append(text[start:pos].translate(self.char_table))
+                    parts.append(phrases[phrase])
+                    pos = start = pos + len(phrase)
+                    break
+            else:
+                pos += 1
+        parts.append(text[start:].translate(self.char_table))
+        return "".join(parts)
+
+def relate_phrases(char, candidates):
+    """related_candidates_table 一行中的 (位置, 完整詞組)，與 lookup_relates 的拆分一致
+
+    候選是接在 char 後面輸出的後綴 (謝 → "謝" 即 "謝謝")，完整詞組總是 char + 候選。
+    """
+    words = [w.strip() for w in candidates.split(" ") if w.strip()]
+    for position, word in enumerate(words):
+        if word != "*":
+            yield position, char + word
+
+ReverseHit = namedtuple("ReverseHit", "key page slot")
+
+class ReverseIndex(BackgroundIndex):
+    """反查索引: 字 → (編碼, 位置)，詞 → (首字, 關聯詞位置)，在 CodeIndex 載入完成後於後台建立
+
+    位置按字典原始順序；選字頻率排序後的實際頁/位由 Q9InputMethodUI.reverse_lookup 換算。
+    """
+    label = "反查索引"
+
+    def __init__(self, code_index):
+        super().__init__(None)
+        self.code_index = code_index
+        self.chars = {}
+        self.phrases = {}
+
+    def _run(self):
+        self.code_index.wait()
+        super()._run()
+
+    def _build(self, _db):
+        # codes / relates 可能是 dict 或編譯字典的 Mapping，只用 items() 遍歷一次
+        chars = {}
+        for code, text in self.code_index.codes.items():
+            for position, char in enumerate(text):
+                if char != "*":
+                    chars.setdefault(char, []).append((code, position))
+        phrases = {}
+        for char, candidates in self.code_index.relates.items():
+            for position, phrase in relate_phrases(char, candidates):
+                phrases.setdefault(phrase, (char, position))
+        # 短編碼和靠前的位置優先
+        self.chars = {char: tuple(sorted(entries, key=lambda e: (len(e[0]), e[0], e[1])))
+                      for char, entries in chars.items()}
+        self.phrases = phrases
+
+    def lookup_char(self, char):
+        self.wait()
+        return [ReverseHit(code, position // 9 + 1, position % 9 + 1)
+                for code, position in self.chars.get(char, ())]
+
+    def lookup_phrase(self, phrase):
+        """詞的首字和在首字關聯詞中的頁/位，不在關聯詞表中返回 None"""
+        self.wait()
+        entry = self.phrases.get(phrase)
+        if entry is None:
+            return None
+        char, position = entry
+        return ReverseHit(char, position // 9 + 1, position % 9 + 1)
+
+class PhraseIndex(BackgroundIndex):
+    """關聯詞詞組的隱式前綴樹: 排序數組 + [lo, hi) 區間，前綴每提交一段只在上一區間內二分縮小
+
+    兩字詞已由首字的關聯詞覆蓋，前綴至少兩字時才需要補全，所以只收三字及以上的詞組 (至多
+    MAX_PHRASE_LENGTH 字)，內存只有一個字串列表和一個排名數組。
+    """
+    label = "詞組前綴樹"
+    MAX_PHRASE_LENGTH = 8
+    MAX_COMPLETIONS = 90  # 十頁
+    END = "\U0010ffff"
+
+    def __init__(self, code_index):
+        super().__init__(None)
+        self.code_index = code_index
+        self.phrases = []
+        self.ranks = array("I")
+        self.root = (0, 0)
+        self.resident_bytes = 0
+
+    def _run(self):
+        self.code_index.wait()
+        super()._run()
+
+    def _build(self, _db):
+        best = {}
+        for char, candidates in self.code_index.relates.items():
+            for position, phrase in relate_phrases(char, candidates):
+                if 3 <= len(phrase) <= self.MAX_PHRASE_LENGTH:
+                    # 同一詞組出現在多行時取最靠前的位置
+                    if position < best.get(phrase, position + 1):
+                        best[phrase] = position
+        phrases = sorted(best)
+        ranks = array("I", (best[phrase] for phrase in phrases))
+        self.resident_bytes = (sys.getsizeof(phrases) + sum(map(sys.getsizeof, phrases))
+                               + ranks.itemsize * len(ranks))
+        self.phrases, self.ranks = phrases, ranks
+        self.root = (0, len(phrases))
+
+    def narrow(self, node, prefix):
+        """node 內以 prefix 開頭的詞組區間 (node 須是 prefix 某個前綴的區間)"""
+        lo, hi = node
+        return (bisect.bisect_left(self.phrases, prefix, lo, hi),
+                bisect.bisect_left(self.phrases, prefix + self.END, lo, hi))
+
+    def completions(self, node, prefix):
+        """區間內比 prefix 長的詞組，按關聯詞位置、長度排序，返回要補全的後綴"""
+        lo, hi = node
+        phrases, ranks = self.phrases, self.ranks
+        best = heapq.nsmallest(self.MAX_COMPLETIONS,
+                               (i for i in range(lo, hi) if len(phrases[i]) > len(prefix)),
+                               key=lambda i: (ranks[i], len(phrases[i]), phrases[i]))
+        return [phrases[i][len(prefix):] for i in best]
+
+    def report(self):
+        if not self.is_ready():
+            return "phrase trie: loading"
+        return (f"phrase trie: {len(self.phrases)} phrases, {self.resident_bytes / 1024:.0f} KiB, "
+                f"build {(self.load_seconds or 0) * 1000:.1f} ms")
+
+class DictionaryWatcher(QObject):
+    """監視字典文件 (dataset.db 和編譯字典)，寫入停止、大小和修改時間穩定後發出 changed
+
+    同時監視所在目錄，文件被整體替換 (rename) 後重新加入監視。
+    """
+    changed = pyqtSignal()
+
+    def __init__(self, paths, debounce_ms=500, parent=None):
+        super().__init__(parent)
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.watcher = QFileSystemWatcher(self)
+        directories = {os.path.dirname(path) for path in self.paths}
+        self.watcher.addPaths([d for d in directories if os.path.isdir(d)])
+        self.watch_files()
+        self.watcher.fileChanged.connect(self.on_change)
+        self.watcher.directoryChanged.connect(self.on_change)
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(debounce_ms)
+        self.timer.timeout.connect(self.check)
+        self.loaded_signature = self.signature()
+        self.pending_signature = None
+
+    def watch_files(self):
+        watched = set(self.watcher.files())
+        missing = [path for path in self.paths if path not in watched and os.path.exists(path)]
+        if missing:
+            self.watcher.addPaths(missing)
+
+    def signature(self):
+        result = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                result.append((st.st_size, st.st_mtime_ns))
+            except OSError:
+                result.append(None)
+        return tuple(result)
+
+    def on_change(self, _path):
+        self.watch_files()
+        self.pending_signature = self.signature()
+        self.timer.start()
+
+    def check(self):
+        current = self.signature()
+        if current != self.pending_signature:
+            # 仍在寫入，再等一輪
+            self.pending_signature = current
+            self.timer.start()
+            return
+        if current != self.loaded_signature:
+            self.changed.emit()
+
+    def mark_loaded(self, signature):
+        self.loaded_signature = signature
+
+def usage_db_path():
+    data_home = os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share")
+    return os.environ.get("Q9_USAGE_DB") or os.path.join(data_home, "q9", "usage.db")
+
+class UsageStore:
+    """每用戶選字頻率/最近使用記錄，按使用情況把候選字往前移 (最多 max_shift 位)
+
+    記錄先寫內存，再由後台線程按批寫入 sqlite，上屏不等待磁盤。
+    context 為編碼 (如 "123") 或 "r:" + 前字 (關聯詞)。
+    """
+    HALF_LIFE_DAYS = 30.0
+    SHIFT_PER_USE = 9
+    FLUSH_INTERVAL = 2.0
+
+    def __init__(self, path, max_shift=18):
+        self.path = path
+        self.max_shift = max_shift
+        self.lock = threading.Lock()
+        self.stats = {}  # (context, word) -> [count, last_used]
+        self._pending = queue.SimpleQueue()
+        self._loaded = threading.Event()
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._thread.start()
+
+    def record(self, context, word):
+        now = time.time()
+        with self.lock:
+            entry = self.stats.setdefault((context, word), [0, 0.0])
+            entry[0] += 1
+            entry[1] = now
+        self._pending.put((context, word, now))
+
+    def score(self, entry, now):
+        """按最近使用衰減的次數"""
+        count, last_used = entry
+        age_days = max(0.0, now - last_used) / 86400
+        return count * 0.5 ** (age_days / self.HALF_LIFE_DAYS)
+
+    def reorder(self, context, words):
+        """穩定重排: 每個字最多前移 max_shift 位，未使用過的字保持原相對順序"""
+        if not words or not self._loaded.is_set():
+            return words
+        now = time.time()
+        with self.lock:
+            scores = [self.score(entry, now) if entry else 0.0
+                      for entry in (self.stats.get((context, word)) for word in words)]
+        if not any(scores):
+            return words
+        keys = []
+        for i, score in enumerate(scores):
+            shift = min(self.max_shift, int(score * self.SHIFT_PER_USE))
+            keys.append((i - shift, -score, i))
+        order = sorted(range(len(words)), key=keys.__getitem__)
+        return [words[i] for i in order]
+
+    def close(self, timeout=2.0):
+        self._closing.set()
+        self._pending.put(None)
+        self._thread.join(timeout)
+
+    def _load(self, conn):
+        conn.execute("""CREATE TABLE IF NOT EXISTS usage (
+            context TEXT NOT NULL, word TEXT NOT NULL,
+            count INTEGER NOT NULL, last_used REAL NOT NULL,
+            PRIMARY KEY (context, word))""")
+        conn.commit()
+        rows = conn.execute("SELECT context, word, count, last_used FROM usage").fetchall()
+        with self.lock:
+            # 載入前已記錄的使用與磁盤記錄合併
+            for context, word, count, last_used in rows:
+                entry = self.stats.setdefault((context, word), [0, 0.0])
+                entry[0] += count
+                entry[1] = max(entry[1], last_used)
+        db_log.info("使用頻率記錄: %d 條 (%s)", len(rows), self.path)
+
+    def _write_batch(self, conn, batch):
+        merged = {}
+        for context, word, used_at in batch:
+            count, last_used = merged.get((context, word), (0, 0.0))
+            merged[(context, word)] = (count + 1, max(last_used, used_at))
+        conn.executemany(
+            "INSERT INTO usage (context, word, count, last_used) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(context, word) DO UPDATE SET count = count + excluded.count, "
+            "last_used = MAX(last_used, excluded.last_used)",
+            [(context, word, count, last_used) for (context, word), (count, last_used) in merged.items()])
+        conn.commit()
+
+    def _writer_loop(self):
+        conn = None
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path)
+            self._load(conn)
+        except (OSError, sqlite3.Error) as e:
+            db_log.error("使用頻率記錄不可用 (只保留在內存): %s", e)
+            if conn is not None:
+                conn.close()
+            conn = None
+        finally:
+            self._loaded.set()
+        running = True
+        while running:
+            item = self._pending.get()
+            # 攢一段時間的記錄再一次寫入 (關閉時立即寫)
+            self._closing.wait(self.FLUSH_INTERVAL)
+            batch = []
+            while item is not None:
+                batch.append(item)
+                try:
+                    item = self._pending.get_nowait()
+                except queue.Empty:
+                    break
+            if item is None:
+                running = False
+            if batch and conn is not None:
+                try:
+                    self._write_batch(conn, batch)
+                except sqlite3.Error as e:
+                    db_log.error("使用頻率寫入失敗: %s", e)
+        if conn is not None:
+            conn.close()
+
+# 預取結果: 排好序的候選和首頁九格文字
+PrefetchedPage = namedtuple("PrefetchedPage", "words first_page")
+
+class CandidatePrefetcher:
+    """輸入編碼前一兩位時，在後台準備下一位可能組成的完整編碼的候選和首頁
+
+    每輸入一位換一代 (generation)，舊一代的後台任務自行放棄；
+    take() 統計命中/未命中，未命中時由調用方同步查詢。
+    """
+    MISSING = object()
+
+    def __init__(self, prepare):
+        self.prepare = prepare  # code -> PrefetchedPage 或 None (沒有候選)
+        self.generation = 0
+        self.pages = {}
+        self.hits = 0
+        self.misses = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="q9-prefetch")
+
+    @staticmethod
+    def next_codes(prefix):
+        """再輸入一位即可查詢的編碼: 一位後只有 "x0"，兩位後是 10 個三位編碼"""
+        if len(prefix) == 1 and prefix != "0":
+            return [prefix + "0"]
+        if len(prefix) == 2:
+            return [prefix + str(digit) for digit in range(10)]
+        return []
+
+    def speculate(self, prefix):
+        self.cancel()
+        codes = self.next_codes(prefix)
+        if codes:
+            self._executor.submit(self._prepare_all, self.generation, codes, self.pages)
+
+    def _prepare_all(self, generation, codes, pages):
+        for code in codes:
+            if generation != self.generation:
+                return
+            try:
+                pages[code] = self.prepare(code)
+            except Exception as e:
+                db_log.error("預取 %s 失敗: %s", code, e)
+                return
+
+    def take(self, code):
+        """返回預取結果 (可能為 None 表示沒有候選)，未準備好時返回 MISSING"""
+        page = self.pages.get(code, self.MISSING)
+        if page is self.MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return page
+
+    def cancel(self):
+        self.generation += 1
+        self.pages = {}
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def close(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+class RelatePrerenderer(QObject):
+    """選字頁顯示期間，在後台為本頁的字準備關聯詞列表和疊加圖 (QImage)
+
+    每個字完成後經 QueuedConnection 送回 GUI 線程；翻頁或重置時換一代，舊任務放棄。
+    """
+    prepared = pyqtSignal(int, str, object, object)  # 代, 字, 關聯詞, {(編號, 文字): QImage}
+
+    def __init__(self, prepare):
+        super().__init__()
+        self.prepare = prepare  # (字, 尺寸, 像素比) -> (關聯詞, 圖像字典)
+        self.generation = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="q9-relate")
+
+    def submit(self, words, size, device_pixel_ratio):
+        self.generation += 1
+        if words:
+            self._executor.submit(self._prepare_all, self.generation, words, QSize(size), device_pixel_ratio)
+
+    def _prepare_all(self, generation, words, size, device_pixel_ratio):
+        for word in words:
+            if generation != self.generation:
+                return
+            try:
+                relates, images = self.prepare(word, size, device_pixel_ratio)
+            except Exception as e:
+                image_log.error("關聯詞預渲染 %s 失敗: %s", word, e)
+                return
+            self.prepared.emit(generation, word, relates, images)
+
+    def cancel(self):
+        self.generation += 1
+
+    def close(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+# struct input_event: timeval (两个 long) + type + code + value，时间由内核填写
+INPUT_EVENT = struct.Struct("llHHi")
+
+def write_uinput_events(uinput, events):
+    """用一次 write 把多个 (type, code, value) 事件写入 uinput 设备"""
+    os.write(uinput.fd, b"".join(INPUT_EVENT.pack(0, 0, etype, code, value) for etype, code, value in events))
+
+class HookedDevice:
+    """一个被独占的输入设备、它的 UInput 镜像，以及事件循环里的组帧状态"""
+
+    def __init__(self, path, device, mirror):
+        self.path = path
+        self.device = device
+        self.mirror = mirror
+        self.can_paste = UInputPasteBackend.supports(mirror)
+        self.frame = []
+        self.dropping = False
+
+    def close(self):
+        for action in (self.device.ungrab, self.device.close, self.mirror.close):
+            try:
+                action()
+            except Exception:
+                pass
+
+class ClipboardOutputBackend:
+    """输出后端基类/回退: 只复制到剪贴板，由用户手动粘贴"""
+    name = "clipboard"
+
+    def __init__(self, app):
+        self.app = app
+
+    def set_clipboard(self, text):
+        self.app.clipboard().setText(text)
+
+    def inject(self, text):
+        self.set_clipboard(text)
+        output_log.info("已复制到剪贴板，请手动粘贴: %s", text)
+
+    def close(self):
+        pass
+
+class UInputPasteBackend(ClipboardOutputBackend):
+    """复用钩子创建的 UInput 虚拟键盘发送 Ctrl+V，不产生子进程
+
+    keyboards: 返回当前可发送 Ctrl+V 的虚拟键盘列表 (设备可能在运行中插拔)
+    fallback: 暂时没有虚拟键盘时使用的后端 (例如 xdotool)，没有时只复制到剪贴板
+    """
+    name = "uinput"
+
+    def __init__(self, app, keyboards, lock, fallback=None):
+        super().__init__(app)
+        self.keyboards = keyboards
+        self.lock = lock
+        self.fallback = fallback
+
+    @staticmethod
+    def supports(virtual_keyboard):
+        try:
+            keys = virtual_keyboard.capabilities().get(ecodes.EV_KEY, [])
+        except Exception:
+            return False
+        return ecodes.KEY_LEFTCTRL in keys and ecodes.KEY_V in keys
+
+    def inject(self, text):
+        keyboards = self.keyboards()
+        if not keyboards:
+            if self.fallback is not None:
+                return self.fallback.inject(text)
+            return super().inject(text)
+        self.set_clipboard(text)
+        # 与事件循环线程共用虚拟键盘，整组按键持锁一次写入，避免和转发的按键交错
+        with self.lock:
+            write_uinput_events(keyboards[0], [
+                (ecodes.EV_KEY, ecodes.KEY_LEFTCTRL, 1),
+                (ecodes.EV_KEY, ecodes.KEY_V, 1),
+                (ecodes.EV_SYN, ecodes.SYN_REPORT, 0),
+                (ecodes.EV_KEY, ecodes.KEY_V, 0),
+                (ecodes.EV_KEY, ecodes.KEY_LEFTCTRL, 0),
+                (ecodes.EV_SYN, ecodes.SYN_REPORT, 0),
+            ])
+
+class XdotoolPasteBackend(ClipboardOutputBackend):
+    """没有可用虚拟键盘时的回退: 每次注入调用一次 xdotool (批量后次数已减少)"""
+    name = "xdotool"
+
+    def inject(self, text):
+        self.set_clipboard(text)
+        subprocess.run(["xdotool", "key", "ctrl+v"], check=True)
+
+class PynputTypeBackend(ClipboardOutputBackend):
+    """Windows: 常驻一个 pynput 键盘控制器直接输入文字"""
+    name = "pynput"
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.controller = keyboard.Controller()
+
+    def inject(self, text):
+        self.controller.type(text)
+
+def env_milliseconds(name, default):
+    try:
+        return max(0, int(os.environ.get(name, default)))
+    except ValueError:
+        output_log.warning("%s 不是整數，使用默認值 %d ms", name, default)
+        return default
+
+class CommitBuffer:
+    """選字與輸出後端之間的提交緩衝: 時間窗口內到達的提交按先後合併成一次注入
+
+    期限從第一條待輸出文字算起，後來的提交不會推遲它；hold() 可以把期限延長到關聯詞窗口。
+    flush() 立即注入 (下一個非關聯按鍵、轉發其他按鍵前、隱藏、關閉、切換簡繁時調用)。
+    window_ms 為 0 時不緩衝，append 直接注入。
+    """
+
+    def __init__(self, inject, window_ms=50, relate_window_ms=0):
+        self.inject = inject
+        self.window_ms = window_ms
+        self.relate_window_ms = relate_window_ms
+        self.pending = []
+        self.commits = 0
+        self.flushes = 0
+        self._first_ns = 0
+        self._deadline_ms = 0
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self.flush)
+
+    def append(self, text):
+        self.pending.append(text)
+        self.commits += 1
+        if self.window_ms == 0:
+            self.flush()
+        elif len(self.pending) == 1:
+            self._first_ns = time.monotonic_ns()
+            self._deadline_ms = 0
+            self._schedule(self.window_ms)
+
+    def hold(self):
+        """提交後出現關聯詞預覽: 再等一會兒，關聯詞可以一起輸出"""
+        if self.pending and self.relate_window_ms > self.window_ms:
+            self._schedule(self.relate_window_ms)
+
+    def _schedule(self, window_ms):
+        if window_ms < self._deadline_ms and self._timer.isActive():
+            return
+        self._deadline_ms = window_ms
+        elapsed_ms = (time.monotonic_ns() - self._first_ns) // 1_000_000
+        self._timer.start(max(0, window_ms - elapsed_ms))
+
+    def flush(self):
+        self._timer.stop()
+        if not self.pending:
+            return
+        text = "".join(self.pending)
+        self.flushes += 1
+        try:
+            self.inject(text)
+        finally:
+            # 注入完成後才清空: 鉤子線程據此判斷轉發的幀要不要排在這段文字之後
+            self.pending = []
+
+def image_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.environ.get("Q9_CACHE_DIR") or os.path.join(cache_home, "q9")
+
+class ImageStore:
+    """九宮格圖像庫，可像 dict 一樣用編號取 QPixmap
+
+    啟動時只掃描一次目錄，首屏只解碼實際顯示的九張圖。若緩存目錄中的圖集 (atlas-*.png + .json)
+    與源圖一致，第一次確定顯示尺寸 (reserve) 後在後台解碼圖集並按該尺寸切出全部圖像，然後釋放
+    圖集；過期或缺失時在後台重建到緩存目錄 (不寫圖像目錄)，供下次啟動使用。
+    半透明版本 (111–119) 在第一次使用時才生成。
+
+    圖像只按顯示需要的尺寸 (圖標尺寸 × 像素比) 保存為 QImage；窗口放大超過已解碼尺寸時
+    才從源文件重新解碼，縮小時沿用現有圖像。
+    """
+    ATLAS_VERSION = 2
+    ATLAS_COLUMNS = 10
+    ALPHA_BASE = 110
+    SOURCE_PATTERN = re.compile(r"^(\d+)_([1-9])\.png$")
+
+    def __init__(self, img_dir, cache_dir=None):
+        self.img_dir = img_dir
+        # 每個圖像目錄一份圖集，按目錄絕對路徑區分
+        key = hashlib.sha1(os.path.abspath(img_dir).encode("utf-8")).hexdigest()[:16]
+        cache_dir = cache_dir or image_cache_dir()
+        self.atlas_path = os.path.join(cache_dir, f"atlas-{key}.png")
+        self.atlas_index_path = os.path.join(cache_dir, f"atlas-{key}.json")
+        self._images = {}
+        self._image_lock = threading.Lock()
+        self.target_size = None  # 解碼尺寸上限 (設備像素)，None 表示原尺寸
+        self.source_sizes = {}
+        self.redecodes = 0
+        self.atlas = None
+        self.atlas_rects = {}
+        self.sources = self._scan_sources()
+        # 圖集等第一次 reserve() 確定尺寸後再切片，否則切出的圖像會被丟棄
+        self.atlas_pending = self._check_atlas()
+        if not self.atlas_pending and self.sources:
+            threading.Thread(target=self.build_atlas, daemon=True).start()
+        image_log.info("圖像來源: %d 張, 圖集: %s", len(self.sources), "有效" if self.atlas_rects else "無")
+
+    def _scan_sources(self):
+        """index -> (路徑, 大小, 修改時間)"""
+        sources = {}
+        try:
+            entries = list(os.scandir(self.img_dir))
+        except OSError as e:
+            image_log.warning("圖像目錄無法讀取: %s (%s)", self.img_dir, e)
+            return sources
+        for entry in entries:
+            match = self.SOURCE_PATTERN.match(entry.name)
+            if not match or int(match.group(1)) > 10:
+                continue
+            index = int(match.group(1)) * 10 + int(match.group(2))
+            st = entry.stat()
+            sources[index] = (entry.path, st.st_size, st.st_mtime_ns)
+        return sources
+
+    def _signature(self):
+        return {str(index): [os.path.basename(path), size, mtime]
+                for index, (path, size, mtime) in self.sources.items()}
+
+    @staticmethod
+    def _file_signature(path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def _check_atlas(self):
+        """圖集索引與源圖、圖集文件本身都一致時記下切片位置"""
+        try:
+            with open(self.atlas_index_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            atlas_signature = self._file_signature(self.atlas_path)
+        except (OSError, ValueError):
+            return False
+        if (meta.get("version") != self.ATLAS_VERSION or meta.get("sources") != self._signature()
+                or meta.get("atlas") != atlas_signature):
+            image_log.info("圖集已過期，將在後台重建")
+            return False
+        self.atlas_rects = {int(k): v for k, v in meta["rects"].items()}
+        return True
+
+    def _decode_atlas(self):
+        atlas = QImage(self.atlas_path)
+        if atlas.isNull():
+            # 圖集在檢查之後被刪除或損壞: 這次逐張載入，並重建圖集供下次啟動使用
+            image_log.warning("圖集解碼失敗，改為逐張載入並重建圖集")
+            self.build_atlas()
+            return
+        # 按當前尺寸切出全部源圖，之後不再保留整張圖集
+        self.atlas = atlas
+        try:
+            for num in sorted(self.sources):
+                self.image(num)
+        finally:
+            self.atlas = None
+
+    def build_atlas(self):
+        """把所有源圖拼成一張圖集 (QImage，可在非 GUI 線程執行)"""
+        try:
+            images = {}
+            for index, (path, _, _) in sorted(self.sources.items()):
+                image = QImage(path)
+                if not image.isNull():
+                    images[index] = image
+            if not images:
+                return
+            cell_w = max(image.width() for image in images.values())
+            cell_h = max(image.height() for image in images.values())
+            rows = (len(images) + self.ATLAS_COLUMNS - 1) // self.ATLAS_COLUMNS
+            atlas = QImage(cell_w * self.ATLAS_COLUMNS, cell_h * rows, QImage.Format_ARGB32_Premultiplied)
+            atlas.fill(Qt.transparent)
+            rects = {}
+            painter = QPainter(atlas)
+            for slot, (index, image) in enumerate(images.items()):
+                x = (slot % self.ATLAS_COLUMNS) * cell_w
+                y = (slot // self.ATLAS_COLUMNS) * cell_h
+                painter.drawImage(x, y, image)
+                rects[str(index)] = [x, y, image.width(), image.height()]
+            painter.end()
+
+            atlas_path, index_path = self.atlas_path, self.atlas_index_path
+            os.makedirs(os.path.dirname(atlas_path), exist_ok=True)
+            # 先寫臨時文件再替換，避免另一個實例讀到一半的圖集
+            suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+            if not atlas.save(atlas_path + suffix, "PNG"):
+                raise OSError(f"無法寫入 {atlas_path}")
+            # os.replace 保留大小和修改時間，索引記下的就是最終圖集文件的簽名
+            with open(index_path + suffix, "w", encoding="utf-8") as f:
+                json.dump({"version": self.ATLAS_VERSION, "sources": self._signature(),
+                           "atlas": self._file_signature(atlas_path + suffix), "rects": rects}, f)
+            os.replace(atlas_path + suffix, atlas_path)
+            os.replace(index_path + suffix, index_path)
+            image_log.info("圖集已重建: %s (%d 張)", atlas_path, len(rects))
+        except Exception as e:
+            image_log.warning("圖集重建失敗: %s", e)
+
+    def __contains__(self, num):
+        if num in self.sources:
+            return True
+        return self.ALPHA_BASE < num < self.ALPHA_BASE + 10 and (num - self.ALPHA_BASE) in self.sources
+
+    def __getitem__(self, num):
+        # 不另存 QPixmap: 調用方 (IconCache) 緩存縮放好的圖標
+        return QPixmap.fromImage(self.image(num))
+
+    def reserve(self, size):
+        """需要 size (設備像素) 的圖像；超過已解碼尺寸時丟棄現有圖像，之後按新尺寸重新解碼"""
+        with self._image_lock:
+            target = self.target_size
+            if target is not None and size.width() <= target.width() and size.height() <= target.height():
+                return
+            self.target_size = size if target is None else target.expandedTo(size)
+            if self._images:
+                self.redecodes += 1
+                image_log.debug("圖像解碼尺寸增大到 %dx%d，重新解碼",
+                                self.target_size.width(), self.target_size.height())
+            self._images = {}
+            decode_atlas = self.atlas_pending
+            self.atlas_pending = False
+        if decode_atlas:
+            threading.Thread(target=self._decode_atlas, daemon=True).start()
+
+    def _fit(self, source_size, target):
+        """源尺寸縮小到 target 內 (保持比例，不放大)"""
+        if target is None or (source_size.width() <= target.width() and source_size.height() <= target.height()):
+            return source_size
+        return source_size.scaled(target, Qt.KeepAspectRatio)
+
+    def image(self, num):
+        """編號對應的 QImage (按 target_size 縮小)，可在後台線程調用"""
+        with self._image_lock:
+            image = self._images.get(num)
+            target = self.target_size
+        if image is not None:
+            return image
+        if num not in self:
+            raise KeyError(num)
+        if num not in self.sources:
+            # 半透明圖像
+            original = self.image(num - self.ALPHA_BASE)
+            image = QImage(original.size(), QImage.Format_ARGB32_Premultiplied)
+            image.fill(Qt.transparent)
+            painter = QPainter(image)
+            painter.setOpacity(0.5)
+            painter.drawImage(0, 0, original)
+            painter.end()
+        else:
+            image = self._decode(num, target)
+        with self._image_lock:
+            # 解碼期間尺寸變了就不保存，下次按新尺寸解碼
+            if self.target_size == target:
+                self._images[num] = image
+        return image
+
+    def _decode(self, num, target):
+        atlas = self.atlas
+        if atlas is not None and num in self.atlas_rects:
+            image = atlas.copy(QRect(*self.atlas_rects[num]))
+            self.source_sizes[num] = image.size()
+            size = self._fit(image.size(), target)
+            if size != image.size():
+                image = image.scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            return image
+        path = self.sources[num][0]
+        reader = QImageReader(path)
+        source_size = reader.size()
+        if source_size.isValid():
+            self.source_sizes[num] = source_size
+            size = self._fit(source_size, target)
+            if size != source_size:
+                reader.setScaledSize(size)
+        image = reader.read()
+        if image.isNull():
+            image_log.warning("圖像載入失敗: %s (%s)", path, reader.errorString())
+        return image
+
+    def scale_of(self, num):
+        """已解碼圖像相對源圖的比例 (用於按比例縮放疊加文字)"""
+        base = num - self.ALPHA_BASE if num not in self.sources else num
+        image = self.image(num)
+        source_size = self.source_sizes.get(base)
+        if not source_size or source_size.width() <= 0:
+            return 1.0
+        return image.width() / source_size.width()
+
+    def resident_bytes(self):
+        """(常駐圖像字節數, 同樣這些圖像按原尺寸保存時的字節數)"""
+        with self._image_lock:
+            images = dict(self._images)
+        resident = sum(image.sizeInBytes() for image in images.values())
+        full = 0
+        for num, image in images.items():
+            source_size = self.source_sizes.get(num if num in self.sources else num - self.ALPHA_BASE)
+            if source_size is not None:
+                full += source_size.width() * source_size.height() * image.depth() // 8
+        return resident, full
+
+# 關聯詞預覽圖標上的文字大小 (相對原圖)
+RELATE_FONT_SIZE = 45
+# 選字頁停留多久後開始後台準備關聯詞預覽
+RELATE_PRERENDER_DELAY_MS = 30
+
+def draw_overlay_text(device, text, font_size):
+    """在圖像左上四分之一處畫黑色粗體文字 (QPixmap 或 QImage 均可)"""
+    painter = QPainter(device)
+    painter.setRenderHint(QPainter.Antialiasing)
+    font = QFont("Arial")
+    font.setPointSizeF(font_size)
+    font.setBold(True)
+    painter.setFont(font)
+    painter.setPen(QPen(QColor(0, 0, 0), 2))
+    text_rect = QRect(0, 0, device.width() // 2, device.height() // 2)
+    painter.drawText(text_rect, Qt.AlignTop | Qt.AlignLeft, text)
+    painter.end()
+
+def render_overlay_icon_image(base, text, font_size, size, device_pixel_ratio):
+    """後台線程版的疊加圖標 (text 為空時只縮放): 與 IconCache 的結果一致，但只用 QImage"""
+    image = base
+    if text:
+        image = base.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        draw_overlay_text(image, text, font_size)
+    return image.scaled(size * device_pixel_ratio, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+class IconCache:
+    """九宮格 QIcon 緩存，鍵為 (圖像編號, 疊加文字, 圖標尺寸)，尺寸改變時整體失效
+
+    按像素字節數做 LRU 淘汰 (圖標越大緩存的個數越少)，但至少保留最近一屏的 min_icons 個。
+    """
+
+    def __init__(self, images, render_overlay, max_bytes=2 * 1024 * 1024, min_icons=9):
+        self.images = images
+        self.render_overlay = render_overlay
+        self.max_bytes = max_bytes
+        self.min_icons = min_icons
+        self.hits = 0
+        self.misses = 0
+        self._icons = OrderedDict()
+        self._bytes = {}
+        self._total_bytes = 0
+
+    def icon(self, num, text="", size=QSize(80, 80), device_pixel_ratio=1.0):
+        """返回現成的 QIcon；沒有對應圖像時返回 None"""
+        key = (num, text, size.width(), size.height())
+        icon = self._icons.get(key)
+        if icon is not None:
+            self._icons.move_to_end(key)
+            self.hits += 1
+            return icon
+        if num not in self.images:
+            return None
+        self.misses += 1
+        self.images.reserve(size * device_pixel_ratio)
+        pixmap = self.images[num]
+        if text:
+            pixmap = self.render_overlay(pixmap, text, self.images.scale_of(num))
+        # 預先縮放到顯示尺寸，繪製時不再縮放
+        pixmap = pixmap.scaled(size * device_pixel_ratio, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        pixmap.setDevicePixelRatio(device_pixel_ratio)
+        return self._store(key, pixmap)
+
+    def put(self, num, text, size, image, device_pixel_ratio=1.0):
+        """放入後台已縮放好的 QImage (GUI 線程調用)"""
+        pixmap = QPixmap.fromImage(image)
+        pixmap.setDevicePixelRatio(device_pixel_ratio)
+        self._store((num, text, size.width(), size.height()), pixmap)
+
+    def _store(self, key, pixmap):
+        icon = QIcon(pixmap)
+        self._icons[key] = icon
+        self._icons.move_to_end(key)
+        self._total_bytes -= self._bytes.get(key, 0)
+        self._bytes[key] = pixmap.width() * pixmap.height() * pixmap.depth() // 8
+        self._total_bytes += self._bytes[key]
+        while self._total_bytes > self.max_bytes and len(self._icons) > self.min_icons:
+            evicted, _ = self._icons.popitem(last=False)
+            self._total_bytes -= self._bytes.pop(evicted)
+        return icon
+
+    def __contains__(self, key):
+        return key in self._icons
+
+    def __len__(self):
+        return len(self._icons)
+
+    def resident_bytes(self):
+        return self._total_bytes
+
+    def invalidate(self):
+        self._icons.clear()
+        self._bytes.clear()
+        self._total_bytes = 0
+
+# 按鈕上次顯示的狀態: 樣式角色 (objectName)、文字、圖標 cacheKey (無圖標為 None)
+GridCell = namedtuple("GridCell", "role text icon_key")
+
+class GridView:
+    """九宮格的視圖模型: 記住每個按鈕上次的狀態，只設置有變化的屬性
+
+    角色改變需要重新套用樣式表，在一次狀態切換結束時對改變的按鈕統一 unpolish/polish。
+    """
+
+    def __init__(self, buttons, role_fonts):
+        self.buttons = buttons
+        self.role_fonts = role_fonts  # 返回 {角色: QFont} 的函數 (字體隨縮放更新)
+        self.cells = {i: GridCell(None, None, None) for i in buttons}
+        self.repolished = 0
+
+    def render(self, cells):
+        """cells: {按鈕號: (角色, 文字, QIcon 或 None)}"""
+        repolish = []
+        for i, (role, text, icon) in cells.items():
+            btn = self.buttons[i]
+            old = self.cells[i]
+            icon_key = icon.cacheKey() if icon is not None else None
+            if role != old.role:
+                btn.setObjectName(role)
+                btn.setFont(self.role_fonts()[role])
+                repolish.append(btn)
+            if icon_key != old.icon_key:
+                btn.setIcon(icon if icon is not None else QIcon())
+            if text != old.text:
+                btn.setText(text)
+            self.cells[i] = GridCell(role, text, icon_key)
+        if repolish:
+            style = repolish[0].style()
+            for btn in repolish:
+                style.unpolish(btn)
+                style.polish(btn)
+            self.repolished += len(repolish)
+
+    def set_text(self, i, text):
+        old = self.cells[i]
+        if text != old.text:
+            self.buttons[i].setText(text)
+            self.cells[i] = old._replace(text=text)
+
 class Q9InputMethodUI(QWidget):
-    def __init__(self, device_path="/dev/input/by-path/pci-0000:67:00.4-usb-0:1:1.0-event-kbd"):
+    # 後台重建好的字典 (見 reload_dictionary)
+    dictionary_reloaded = pyqtSignal(object)
+
+    def __init__(self, device_path="/dev/input/by-path/pci-0000:67:00.4-usb-0:1:1.0-event-kbd", start_hook=True):
         super().__init__()
 
         # 检测操作系统
         self.current_os = platform.system()
-        print(f"当前操作系统: {self.current_os}")
+        log.info("当前操作系统: %s", self.current_os)
 
         # 狀態變量
         self.current_input = ""
         self.current_page = "input"
         self.db_path = "files/dataset.db"
-        self.db_connection = None
+        self.dataset = None
+        self.code_index = None
+        self.ts_converter = None
+        self.reverse_index = None
         self.app = QApplication.instance()
 
         # 選字模式
@@ -69,50 +1463,90 @@ class Q9InputMethodUI(QWidget):
         self.curr_page = 0
         self.total_page = 0
         self.select_mode = False
+        self.select_context = None
 
         # 關聯詞
         self.last_word = ""
         self.current_relates = []
         self.showing_relates = False        
+        self.relate_context = ""  # 預覽中的關聯詞來源: "r:" + 字 或 "p:" + 詞組前綴
+        # 已連續提交的詞組前綴及其在 PhraseIndex 中的區間
+        self.phrase_index = None
+        self.phrase_prefix = ""
+        self.phrase_node = None
         self.sc_output = False
 
         # 添加隐藏状态变量和窗口几何信息
         self.is_hidden = False
         self.saved_geometry = None
+        self.resident = False  # 常驻模式 (--resident)，关闭窗口时只隐藏
+        self.instance_server = None
+
+        # 延遲統計 (Q9_TRACE=1 啟動時開啟，也可在右鍵菜單切換)
+        self.tracer = LatencyTracer(enabled=os.environ.get("Q9_TRACE") == "1")
+        self.trace_file = os.environ.get("Q9_TRACE_FILE", "q9_latency.txt")
+        self.install_trace_dump_signal()
+
+        # 按鍵投遞: 鉤子回調直接 emit，事件循環喚醒 GUI 線程處理
+        self.key_bridge = KeyEventBridge()
+        self.key_bridge.key_received.connect(self.on_key_received, Qt.QueuedConnection)
+        self.key_bridge.frame_received.connect(self.on_frame_received, Qt.QueuedConnection)
+        # 钩子线程只写 *_posted / frames_deferred，GUI 线程只写 keys_handled / frames_written
+        self.keys_posted = self.keys_handled = 0
+        self.frames_deferred = self.frames_written = 0
 
         # Keyboard hook setup
         self.setup_keyboard_hook_variables(device_path)        
 
         # 初始化 DB
+        self.tracer.sections.append(self.dataset_report)
+        self.tracer.sections.append(self.phrase_report)
         self.init_database()
 
-        # 載入圖片
-        self.images = {}
-        for type_val in range(11):
-            for i in range(1, 10):
-                index = type_val * 10 + i
-                img_path = f"files/img/{type_val}_{i}.png"
-                if os.path.exists(img_path):
-                    self.images[index] = QPixmap(img_path)
-                    print(f"載入圖像: {img_path}")
-                else:
-                    print(f"圖像未找到: {img_path}")
-
-        # 半透明圖像
-        for j in range(1, 10):
-            index = 110 + j
-            if j in self.images:
-                original = self.images[j]
-                transparent_pixmap = QPixmap(original.size())
-                transparent_pixmap.fill(Qt.transparent)
-                painter = QPainter(transparent_pixmap)
-                painter.setOpacity(0.5)
-                painter.drawPixmap(0, 0, original)
-                painter.end()
-                self.images[index] = transparent_pixmap
+        # 選字頻率: 常用字逐步前移 (Q9_ADAPTIVE=0 關閉)
+        self.usage_store = None
+        if os.environ.get("Q9_ADAPTIVE", "1") != "0":
+            self.usage_store = UsageStore(usage_db_path())
+        # 前兩位輸入時預先準備第三位的候選
+        self.prefetcher = CandidatePrefetcher(self.prepare_candidates)
+
+        # 載入圖片 (圖集切片/按需解碼，半透明版本延遲生成)
+        self.images = ImageStore("files/img")
+
+        # 输出: 短时间内的提交合并为一次注入
+        # Q9_COMMIT_FLUSH_MS: 普通提交的合并窗口；Q9_COMMIT_RELATE_FLUSH_MS: 出现关联词预览时的窗口
+        # 只有 Linux 钩子能让转发的其他按键排在缓冲文字之后 (见 forward_frame)，其他平台默认不缓冲
+        self.output_backend = None
+        hook_active = self.linux_hook_active()
+        self.commit_buffer = CommitBuffer(
+            self.inject_text,
+            window_ms=env_milliseconds("Q9_COMMIT_FLUSH_MS", 50 if hook_active else 0),
+            relate_window_ms=env_milliseconds("Q9_COMMIT_RELATE_FLUSH_MS", 250 if hook_active else 0))
+
+        # 九宮格圖標緩存，切換狀態時只替換 QIcon
+        self.grid_icon_size = QSize(80, 80)
+        self.tracer.sections.append(self.image_memory_report)
+        self.icon_cache = IconCache(
+            self.images,
+            lambda base, text, scale: self.create_text_overlay_image(base, text, font_size=RELATE_FONT_SIZE * scale))
+
+        # 選字頁上各字的關聯詞預覽在後台準備好，選字後直接顯示
+        self.prerendered_relates = {}
+        self.prerender_size = (QSize(self.grid_icon_size), 1.0)
+        self.prerender_words = []
+        self.relate_prerenderer = RelatePrerenderer(self.prepare_relate_preview)
+        self.relate_prerenderer.prepared.connect(self.on_relate_prerendered, Qt.QueuedConnection)
+        # 頁面停留片刻才開始，連續按鍵時不與前台爭搶 CPU
+        self.relate_prerender_timer = QTimer(self)
+        self.relate_prerender_timer.setSingleShot(True)
+        self.relate_prerender_timer.setInterval(RELATE_PRERENDER_DELAY_MS)
+        self.relate_prerender_timer.timeout.connect(self.start_relate_prerender)
 
         self.init_ui()
-        self.start_keyboard_hook()
+        # start_hook=False: 不抓取鍵盤 (基準測試/無頭運行)
+        if start_hook:
+            self.start_keyboard_hook()
+        self.output_backend = self.create_output_backend()
 
     def set_best_chinese_font(self):
         fontTargets = [
@@ -133,13 +1567,16 @@ class Q9InputMethodUI(QWidget):
                 app_font = QFont(target)
                 app_font.setPointSize(12)  # 你可以調整字號
                 QApplication.setFont(app_font)
-                print(f"已套用字體: {target}")
+                ui_log.info("已套用字體: %s", target)
                 return target
-        print("未找到匹配的中文字體，使用系統預設字體")
+        ui_log.info("未找到匹配的中文字體，使用系統預設字體")
         return None
+    def linux_hook_active(self):
+        return self.current_os == "Linux" and LINUX_EVDEV_AVAILABLE
+
     def setup_keyboard_hook_variables(self, device_path):
         """根据操作系统设置键盘钩子变量"""
-        if self.current_os == "Linux" and LINUX_EVDEV_AVAILABLE:
+        if self.linux_hook_active():
             self.setup_linux_keyboard_hook(device_path)
         elif self.current_os == "Windows" and WINDOWS_PYNPUT_AVAILABLE:
             self.setup_windows_keyboard_hook_improved()
@@ -154,27 +1591,38 @@ class Q9InputMethodUI(QWidget):
                 from ctypes import windll
                 result = windll.user32.UnhookWindowsHookEx(self.hook_id)
                 if result:
-                    print("Windows API 钩子已清理")
+                    hook_log.info("Windows API 钩子已清理")
                 else:
-                    print("Windows API 钩子清理失败")
+                    hook_log.warning("Windows API 钩子清理失败")
                 self.hook_id = None
             except Exception as e:
-                print(f"清理Windows API钩子失败: {e}")
+                hook_log.error("清理Windows API钩子失败: %s", e)
         
         # 清理pynput listener
         if hasattr(self, 'pynput_listener') and self.pynput_listener:
             try:
                 self.pynput_listener.stop()
-                print("Pynput listener已停止")
+                hook_log.info("Pynput listener已停止")
             except Exception as e:
-                print(f"停止pynput listener失败: {e}")
+                hook_log.error("停止pynput listener失败: %s", e)
     def setup_linux_keyboard_hook(self, device_path):
-        """设置Linux evdev键盘钩子"""
-        self.device_path = device_path
+        """设置Linux evdev键盘钩子 (device_path 可为单个路径或路径列表)"""
+        if device_path is None:
+            self.device_paths = []
+        elif isinstance(device_path, str):
+            self.device_paths = [device_path]
+        else:
+            self.device_paths = list(device_path)
         self.running = True
-        self.original_device = None
-        self.virtual_keyboard = None
-        self.key_queue = Queue()
+        # path -> HookedDevice，只在事件循环线程中整体替换 (写时复制)，其他线程只读快照
+        self.hooked_devices = {}
+        # 运行中增删设备: 命令放入队列，再写管道唤醒事件循环
+        self.device_commands = queue.SimpleQueue()
+        self.device_wake_r, self.device_wake_w = os.pipe()
+        os.set_blocking(self.device_wake_r, False)
+        os.set_blocking(self.device_wake_w, False)
+        # 事件循环线程和输出后端共用虚拟键盘
+        self.uinput_lock = threading.Lock()
         self.key_map = {
             ecodes.KEY_KP0: "0",
             ecodes.KEY_KP1: "1",
@@ -190,12 +1638,11 @@ class Q9InputMethodUI(QWidget):
             ecodes.KEY_F10: "F10",
         }
         self.intercepted_codes = set(self.key_map.keys())
-        print("Linux evdev 键盘钩子设置完成")
+        hook_log.info("Linux evdev 键盘钩子设置完成")
 
     def setup_windows_keyboard_hook_improved(self):
         """修正的 Windows API 鍵盤鉤子設置 (帶詳細日誌)"""
         self.running = True
-        self.key_queue = Queue()
 
         try:
             import ctypes
@@ -212,7 +1659,7 @@ class Q9InputMethodUI(QWidget):
                 wintypes.LPARAM  # lParam
             )
 
-            print(f"[DEBUG] HOOKPROC 類型: {self.HOOKPROC}, id={id(self.HOOKPROC)}")
+            hook_log.debug("HOOKPROC 類型: %s, id=%s", self.HOOKPROC, id(self.HOOKPROC))
 
             # 常量
             self.WH_KEYBOARD_LL = 13
@@ -230,18 +1677,17 @@ class Q9InputMethodUI(QWidget):
                 ]
             self.KBDLLHOOKSTRUCT = KBDLLHOOKSTRUCT
 
-            print("Windows API 鍵盤鉤子結構設置完成")
+            hook_log.info("Windows API 鍵盤鉤子結構設置完成")
 
         except Exception as e:
-            print(f"Windows API 鉤子設置失敗（回退到簡化鉤子）: {e}")
+            hook_log.warning("Windows API 鉤子設置失敗（回退到簡化鉤子）: %s", e)
             self.use_win32_hook = False
             self.setup_windows_keyboard_hook_simple()
 
     def setup_fallback_keyboard_hook(self):
         """设置回退模式（仅UI，无键盘钩子）"""
         self.running = False
-        self.key_queue = Queue()
-        print("警告: 键盘钩子不可用，仅运行UI模式")
+        hook_log.warning("警告: 键盘钩子不可用，仅运行UI模式")
 
     def position_window_right_center(self):
         """将窗口定位到屏幕右侧中央"""
@@ -261,10 +1707,10 @@ class Q9InputMethodUI(QWidget):
             
             # 移动窗口
             self.move(x, y)
-            print(f"窗口定位到: ({x}, {y})")
+            ui_log.info("窗口定位到: (%d, %d)", x, y)
             
         except Exception as e:
-            print(f"窗口定位失败: {e}")
+            ui_log.warning("窗口定位失败: %s", e)
     def start_keyboard_hook(self):
         """根据操作系统启动对应的键盘钩子"""
         if self.current_os == "Linux" and LINUX_EVDEV_AVAILABLE:
@@ -272,25 +1718,62 @@ class Q9InputMethodUI(QWidget):
         elif self.current_os == "Windows" and WINDOWS_PYNPUT_AVAILABLE:
             self.start_windows_keyboard_hook_improved()
         else:
-            print("键盘钩子不可用，程序仍可通过鼠标点击使用")
+            hook_log.warning("键盘钩子不可用，程序仍可通过鼠标点击使用")
     
     def start_linux_keyboard_hook(self):
-        """启动Linux evdev键盘钩子"""
-        print(f"寻找键盘设备: {self.device_path}...", file=sys.stderr, flush=True)
+        """启动Linux evdev键盘钩子: 独占所有选定设备，由一个线程统一读取"""
+        hooked_devices = {}
+        for path in self.device_paths:
+            hooked = self.open_input_device(path)
+            if hooked:
+                hooked_devices[path] = hooked
+        self.hooked_devices = hooked_devices
+        if not hooked_devices:
+            hook_log.warning("没有成功独占的键盘设备，可在运行中添加")
+        # 即使暂时没有设备也启动事件循环，之后插入的设备可以直接加入
+        threading.Thread(target=self.linux_event_loop, daemon=True).start()
+
+    def open_input_device(self, path):
+        """打开并独占一个输入设备，为它创建 UInput 镜像；失败返回 None"""
+        hook_log.info("寻找键盘设备: %s...", path)
+        device = None
+        mirror = None
         try:
-            self.original_device = InputDevice(self.device_path)
-            print(f"成功连接到原始键盘: {self.original_device.name}", file=sys.stderr, flush=True)
-            self.virtual_keyboard = UInput.from_device(self.original_device, name='Virtual Keyboard')
-            print("成功创建虚拟键盘设备。", file=sys.stderr, flush=True)
-            self.original_device.grab()
-            print("已独占原始键盘设备。", file=sys.stderr, flush=True)
-            threading.Thread(target=self.linux_event_loop, daemon=True).start()
-            # 启动按键队列处理定时器
-            self.key_timer = QTimer(self)
-            self.key_timer.timeout.connect(self.process_key_queue)
-            self.key_timer.start(100)
+            device = InputDevice(path)
+            hook_log.info("成功连接到原始键盘: %s", device.name)
+            mirror = UInput.from_device(device, name='Virtual Keyboard')
+            hook_log.info("成功创建虚拟键盘设备。")
+            device.grab()
+            hook_log.info("已独占原始键盘设备。")
+            return HookedDevice(path, device, mirror)
         except Exception as e:
-            print(f"Linux 键盘钩子启动失败: {e}", file=sys.stderr, flush=True)
+            hook_log.error("Linux 键盘钩子启动失败: %s (%s)", path, e)
+            for resource in (mirror, device):
+                if resource is not None:
+                    try:
+                        resource.close()
+                    except Exception:
+                        pass
+            return None
+
+    def add_input_device(self, path):
+        """运行中加入一个设备 (任意线程可调用)"""
+        self.send_device_command("add", path)
+
+    def remove_input_device(self, path):
+        """运行中释放一个设备 (任意线程可调用)"""
+        self.send_device_command("remove", path)
+
+    def send_device_command(self, command, path):
+        self.device_commands.put((command, path))
+        try:
+            os.write(self.device_wake_w, b"\0")
+        except BlockingIOError:
+            pass  # 管道已满，事件循环本来就会被唤醒
+
+    def paste_keyboards(self):
+        """当前可发送 Ctrl+V 的虚拟键盘"""
+        return [hooked.mirror for hooked in getattr(self, "hooked_devices", {}).values() if hooked.can_paste]
 
     def start_windows_keyboard_hook_improved(self):
         """啟動 Windows API 鍵盤鉤子 (使用 SetWindowsHookExA + hMod=0 避免 126 錯誤)"""
@@ -306,10 +1789,10 @@ class Q9InputMethodUI(QWidget):
                     if nCode >= 0 and wParam in (self.WM_KEYDOWN, self.WM_SYSKEYDOWN):
                         kbd_struct = cast(lParam, POINTER(self.KBDLLHOOKSTRUCT)).contents
                         vk_code = kbd_struct.vkCode
-                        print(f"Win32 Hook: VK Code = {vk_code}")
+                        hook_log.debug("Win32 Hook: VK Code = %s", vk_code)
 
                         if vk_code == 0x79:  # F10
-                            self.key_queue.put("F10")
+                            self.post_key("F10")
                             return 1
 
                         numpad_vk_map = {
@@ -318,13 +1801,13 @@ class Q9InputMethodUI(QWidget):
                             0x68: "8", 0x69: "9", 0x6E: "."
                         }
                         if vk_code in numpad_vk_map and not self.is_hidden:
-                            self.key_queue.put(numpad_vk_map[vk_code])
+                            self.post_key(numpad_vk_map[vk_code])
                             return 1
 
                     return windll.user32.CallNextHookEx(self.hook_id, nCode, wParam, lParam)
 
                 except Exception as e:
-                    print(f"鉤子回調錯誤: {e}")
+                    hook_log.error("鉤子回調錯誤: %s", e)
                     return windll.user32.CallNextHookEx(self.hook_id, nCode, wParam, lParam)
 
             # ✅ 實例化回調並保留引用
@@ -351,19 +1834,15 @@ class Q9InputMethodUI(QWidget):
 
             if not self.hook_id:
                 err = windll.kernel32.GetLastError()
-                print(f"Windows API 鉤子安裝失敗, 錯誤代碼: {err}")
+                hook_log.error("Windows API 鉤子安裝失敗, 錯誤代碼: %s", err)
                 self.use_win32_hook = False
                 return self.start_windows_keyboard_hook_simple()
 
-            print(f"Windows API 鍵盤鉤子安裝成功 (Hook ID: {self.hook_id})")
-
-            self.key_timer = QTimer(self)
-            self.key_timer.timeout.connect(self.process_key_queue)
-            self.key_timer.start(10)
+            hook_log.info("Windows API 鍵盤鉤子安裝成功 (Hook ID: %s)", self.hook_id)
             return True
 
         except Exception as e:
-            print(f"Windows API 鉤子啟動失敗: {e}")
+            hook_log.error("Windows API 鉤子啟動失敗: %s", e)
             self.use_win32_hook = False
             return self.start_windows_keyboard_hook_simple()
 
@@ -372,30 +1851,30 @@ class Q9InputMethodUI(QWidget):
     def on_windows_key_press(self, key):
         """Windows 按键按下事件处理 - 简化版 - 永远不返回False"""
         try:
-            print(f"Windows 按键检测: {key}")
+            hook_log.debug("Windows 按键检测: %s", key)
             
             # 处理F10键
             if key == keyboard.Key.f10:
-                print("F10 detected")
-                self.key_queue.put("F10")
+                hook_log.debug("F10 detected")
+                self.post_key("F10")
                 return  # 不返回False，让系统正常处理F10
             
             # 处理数字键盘 - 使用VK码检测
             if hasattr(key, 'vk') and key.vk is not None:
                 if key.vk in self.numpad_vk_map:
                     mapped_key = self.numpad_vk_map[key.vk]
-                    print(f"Numpad key detected: VK={key.vk} -> {mapped_key}")
+                    hook_log.debug("Numpad key detected: VK=%s -> %s", key.vk, mapped_key)
                     
                     if not self.is_hidden:  # 只有界面显示时才处理
-                        self.key_queue.put(mapped_key)
-                        print(f"Key added to queue: {mapped_key}")
+                        self.post_key(mapped_key)
+                        hook_log.debug("Key added to queue: %s", mapped_key)
                         # 不返回False，让按键正常传递
                         # 用户需要手动删除在其他应用中输入的数字
                     else:
-                        print("Interface hidden, key passed through normally")
+                        hook_log.debug("Interface hidden, key passed through normally")
                         
         except Exception as e:
-            print(f"Windows 按键处理错误: {e}")
+            hook_log.error("Windows 按键处理错误: %s", e)
 
     def on_windows_key_release(self, key):
         """Windows 按键释放事件处理 - 简化版"""
@@ -405,99 +1884,268 @@ class Q9InputMethodUI(QWidget):
     def toggle_visibility(self):
         """切换窗口可见性并保存/恢复位置"""
         if self.is_hidden:
-            self.show()
             if self.saved_geometry:
-                self.setGeometry(self.saved_geometry)  # 恢复原始位置和大小
+                self.setGeometry(self.saved_geometry)  # 先恢复位置和大小，显示时只绘制一帧
+            self.show()
             self.is_hidden = False
-            print("窗口显示，位置已恢复")
+            ui_log.info("窗口显示，位置已恢复")
         else:
+            self.flush_output()  # 隐藏前输出缓冲中的文字
+            self.phrase_prefix, self.phrase_node = "", None
             self.saved_geometry = self.geometry()  # 保存当前位置和大小
             self.hide()
             self.is_hidden = True
-            print("窗口隐藏，位置已保存")
+            ui_log.info("窗口隐藏，位置已保存")
 
     def linux_event_loop(self):
-        """Linux evdev 事件循环"""
-        while self.running:
-            try:
-                for event in self.original_device.read_loop():
-                    if event.type != ecodes.EV_KEY:
-                        self.virtual_keyboard.write(event.type, event.code, event.value)
-                        self.virtual_keyboard.syn()
-                        continue
-                    
-                    # 处理F10键 - 始终拦截
-                    if event.code == ecodes.KEY_F10 and event.value == KeyEvent.key_down:
-                        self.key_queue.put("F10")
-                        continue
-                    
-                    # 如果界面隐藏，数字键盘按键正常传递
-                    if self.is_hidden and event.code in self.intercepted_codes and event.code != ecodes.KEY_F10:
-                        self.virtual_keyboard.write(event.type, event.code, event.value)
-                        self.virtual_keyboard.syn()
+        """Linux evdev 事件循环: 一个 selector 同时等待所有设备和控制管道
+
+        设备读取出错 (例如小键盘被拔出) 只移除该设备，循环继续运行。
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(self.device_wake_r, selectors.EVENT_READ, None)
+        for hooked in self.hooked_devices.values():
+            selector.register(hooked.device.fd, selectors.EVENT_READ, hooked)
+        try:
+            while self.running:
+                for key, _ in selector.select(timeout=0.5):
+                    hooked = key.data
+                    if hooked is None:
+                        self.apply_device_commands(selector)
                         continue
-                    
-                    # 界面显示时，拦截数字键盘按键用于输入法
-                    if event.code in self.intercepted_codes and event.value == KeyEvent.key_down:
-                        key = self.key_map.get(event.code)
-                        if key and key != "F10":
-                            self.key_queue.put(key)
-                            continue
-                    
-                    # 其他按键正常传递
-                    self.virtual_keyboard.write(event.type, event.code, event.value)
-                    self.virtual_keyboard.syn()
-                    
-            except Exception as e:
-                print(f"Linux 事件循环错误: {e}", file=sys.stderr, flush=True)
-                break
-    
-    def process_key_queue(self):
-        """处理按键队列 - 改进版"""
-        processed_count = 0
-        max_process = 10  # 每次最多处理10个按键，避免阻塞UI
-        
+                    if hooked.path not in self.hooked_devices:
+                        continue  # 本轮已被移除
+                    try:
+                        self.read_device_events(hooked)
+                    except OSError as e:
+                        hook_log.warning("输入设备已断开: %s (%s)", hooked.path, e)
+                        self.detach_input_device(hooked, selector)
+                    except Exception as e:
+                        hook_log.error("Linux 事件循环错误: %s", e)
+        finally:
+            selector.close()
+
+    def read_device_events(self, hooked):
+        """非阻塞读取设备上所有待处理事件，按设备自己的 SYN_REPORT 组帧，每帧一次写出"""
+        try:
+            events = list(hooked.device.read())
+        except BlockingIOError:
+            return
+        for event in events:
+            if event.type == ecodes.EV_SYN:
+                if event.code == ecodes.SYN_DROPPED:
+                    # 内核缓冲溢出: 丢弃到下一个 SYN_REPORT 为止的不完整帧
+                    hooked.frame = []
+                    hooked.dropping = True
+                elif event.code == ecodes.SYN_REPORT:
+                    # 小键盘按键被拦截后只剩 MSC_SCAN 等附带事件的帧不写出
+                    if not hooked.dropping and any(e.type not in FRAME_ONLY_EVENT_TYPES for e in hooked.frame):
+                        hooked.frame.append(event)
+                        self.forward_frame(hooked, hooked.frame)
+                    hooked.frame = []
+                    hooked.dropping = False
+                elif not hooked.dropping:
+                    hooked.frame.append(event)
+                continue
+            if not hooked.dropping and self.should_forward(event):
+                hooked.frame.append(event)
+
+    def apply_device_commands(self, selector):
+        try:
+            while os.read(self.device_wake_r, 64):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                command, path = self.device_commands.get_nowait()
+            except queue.Empty:
+                return
+            hooked = self.hooked_devices.get(path)
+            if command == "add" and hooked is None:
+                hooked = self.open_input_device(path)
+                if hooked:
+                    selector.register(hooked.device.fd, selectors.EVENT_READ, hooked)
+                    self.hooked_devices = {**self.hooked_devices, path: hooked}
+                    hook_log.info("已加入输入设备: %s", path)
+            elif command == "remove" and hooked is not None:
+                self.detach_input_device(hooked, selector)
+                hook_log.info("已释放输入设备: %s", path)
+
+    def detach_input_device(self, hooked, selector):
+        try:
+            selector.unregister(hooked.device.fd)
+        except (KeyError, ValueError, OSError):
+            pass
+        self.hooked_devices = {path: other for path, other in self.hooked_devices.items() if other is not hooked}
+        with self.uinput_lock:
+            hooked.close()
+
+    def should_forward(self, event):
+        """拦截输入法按键 (投递到 GUI 线程) 并返回 False，其余事件返回 True 原样转发"""
+        if event.type != ecodes.EV_KEY:
+            return True
+
+        # 处理F10键 - 始终拦截
+        if event.code == ecodes.KEY_F10 and event.value == KeyEvent.key_down:
+            self.post_key("F10")
+            return False
+
+        # 如果界面隐藏，数字键盘按键正常传递
+        if self.is_hidden and event.code in self.intercepted_codes and event.code != ecodes.KEY_F10:
+            return True
+
+        # 界面显示时，拦截数字键盘按键用于输入法
+        if event.code in self.intercepted_codes and event.value == KeyEvent.key_down:
+            key = self.key_map.get(event.code)
+            if key and key != "F10":
+                self.post_key(key)
+                return False
+
+        # 其他按键正常传递
+        return True
+
+    def forward_frame(self, hooked, frame):
+        """转发一整帧 (以设备的 SYN_REPORT 结尾)
+
+        还有输入法按键未处理、提交缓冲里有文字，或前面的帧还在 GUI 线程排队时，
+        帧交给 GUI 线程在注入文字之后写出，保证目标程序收到的顺序与按键顺序一致。
+        """
+        if (self.keys_posted != self.keys_handled or self.frames_deferred != self.frames_written
+                or self.commit_buffer.pending):
+            self.frames_deferred += 1
+            self.key_bridge.frame_received.emit(hooked, frame)
+            return
+        self.write_frame(hooked, frame)
+
+    def on_frame_received(self, hooked, frame):
         try:
-            while processed_count < max_process:
-                key = self.key_queue.get_nowait()
-                print(f"Processing key from queue: {key}")
-                self.handle_key_input(key)
-                processed_count += 1
-        except Empty:
-            pass  # 队列为空，正常情况
+            self.flush_output()
+            if hooked in self.hooked_devices.values():
+                self.write_frame(hooked, frame)
+        except OSError as e:
+            hook_log.warning("转发按键失败: %s (%s)", hooked.path, e)
+        finally:
+            self.frames_written += 1
+
+    def write_frame(self, hooked, frame):
+        """把一帧一次写入该设备的虚拟键盘 (与输出后端的注入互斥)"""
+        with self.uinput_lock:
+            write_uinput_events(hooked.mirror, [(e.type, e.code, e.value) for e in frame])
+        if self.tracer.enabled:
+            self.tracer.count("forwarded_frames")
+            self.tracer.count("forwarded_events", len(frame))
+
+    def post_key(self, key):
+        """从任意线程投递按键，GUI 线程在下一次事件循环中处理"""
+        self.keys_posted += 1
+        self.key_bridge.key_received.emit(key, self.tracer.now())
+
+    def on_key_received(self, key, stamp=0):
+        """GUI 线程按键处理入口 (每个按键一次，无批量上限)"""
+        if stamp:
+            self.tracer.record("queue", stamp)
+        try:
+            ui_log.debug("Processing key: %s", key)
+            self.handle_key_input(key)
         except Exception as e:
-            print(f"处理按键队列时出错: {e}")
+            ui_log.exception("处理按键时出错: %s", e)
+        finally:
+            self.keys_handled += 1
+        if stamp:
+            self.tracer.record("total", stamp)
+
+    def install_trace_dump_signal(self):
+        """SIGUSR1 时把延迟统计写入 trace_file (POSIX)"""
+        if not hasattr(signal, "SIGUSR1"):
+            return
+        try:
+            # Qt 事件循环中 Python 信号处理器不会及时执行，用 wakeup fd 唤醒
+            self.signal_rsock, self.signal_wsock = socket.socketpair()
+            self.signal_rsock.setblocking(False)
+            self.signal_wsock.setblocking(False)
+            signal.set_wakeup_fd(self.signal_wsock.fileno())
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump_latency_report())
+            self.signal_notifier = QSocketNotifier(self.signal_rsock.fileno(), QSocketNotifier.Read, self)
+            self.signal_notifier.activated.connect(self.drain_signal_socket)
+        except (OSError, ValueError) as e:
+            trace_log.warning("延迟统计信号安装失败: %s", e)
+
+    def drain_signal_socket(self):
+        try:
+            while self.signal_rsock.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+
+    def toggle_latency_trace(self):
+        self.tracer.enabled = not self.tracer.enabled
+        if self.tracer.enabled:
+            self.tracer.reset()
+        trace_log.info("延迟统计: %s", "开启" if self.tracer.enabled else "关闭")
+
+    def dump_latency_report(self):
+        try:
+            self.tracer.dump(self.trace_file)
+            trace_log.info("延迟统计已写入: %s", self.trace_file)
+        except OSError as e:
+            trace_log.error("延迟统计写入失败: %s", e)
+        trace_log.info("%s", self.tracer.report())
+
+    def handle_instance_command(self, command):
+        """常驻模式下其他启动实例发来的命令"""
+        ui_log.info("实例命令: %s", command)
+        if command == "toggle":
+            self.toggle_visibility()
+        elif command == "show":
+            if self.is_hidden:
+                self.toggle_visibility()
+        elif command == "hide":
+            if not self.is_hidden:
+                self.toggle_visibility()
+        elif command == "quit":
+            self.resident = False
+            self.close()
+            self.app.quit()
+            return
+        else:
+            ui_log.warning("未知的实例命令: %s", command)
+            return
+        if not self.is_hidden:
+            self.raise_()
 
     def closeEvent(self, event):
         """修正的closeEvent，包含完整的清理逻辑"""
+        if self.resident:
+            # 常驻模式: 关闭只隐藏窗口，保留缓存和设备，下次启动直接显示
+            event.ignore()
+            if not self.is_hidden:
+                self.toggle_visibility()
+            return
         self.running = False
+        if self.instance_server is not None:
+            self.instance_server.close()
+
+        # 先把尚未注入的文字输出，再关闭虚拟键盘
+        self.flush_output()
+        if self.output_backend:
+            self.output_backend.close()
+        self.prefetcher.close()
+        self.relate_prerenderer.close()
+        if self.usage_store is not None:
+            self.usage_store.close()
         
         # 清理Windows钩子
         if self.current_os == "Windows":
             self.cleanup_windows_hook()
         
-        # Linux 清理
-        if self.current_os == "Linux" and hasattr(self, 'original_device') and self.original_device:
-            try:
-                self.original_device.ungrab()
-            except Exception:
-                pass
-            try:
-                self.original_device.close()
-            except Exception:
-                pass
-        if hasattr(self, 'virtual_keyboard') and self.virtual_keyboard:
-            try:
-                self.virtual_keyboard.close()
-            except Exception:
-                pass
-            
-        # 数据库清理
-        if self.db_connection:
-            try:
-                self.db_connection.close()
-            except Exception:
-                pass
+        # Linux 清理: 释放所有独占的设备和虚拟键盘
+        if self.current_os == "Linux" and hasattr(self, 'hooked_devices'):
+            hooked_devices = self.hooked_devices
+            self.hooked_devices = {}
+            with self.uinput_lock:
+                for hooked in hooked_devices.values():
+                    hooked.close()
             
         event.accept()
 
@@ -515,69 +2163,8 @@ class Q9InputMethodUI(QWidget):
         #self.setWindowFlags(Qt.WindowStaysOnTopHint | Qt.FramelessWindowHint)
         self.setWindowFlags(Qt.WindowStaysOnTopHint | Qt.WindowCloseButtonHint)
 
-        # 紧凑的白底主题样式
-        self.setStyleSheet("""
-            QWidget {
-                background-color: #ffffff;
-                color: #000000;
-            }
-            QPushButton {
-                background-color: #f0f0f0;
-                border: 1px solid #cccccc;  /* 边框从2px减少到1px */
-                border-radius: 2px;         /* 圆角从5px减少到3px */
-                color: #000000;
-                font-size: 26px;           /* 字体从30px减少到26px */
-                font-weight: bold;
-                padding: 2px;              /* padding从5px减少到2px */
-                min-height: 80px;          /* 高度从70px减少到55px */
-                text-align: center;
-            }
-            QPushButton#NumberButton {
-                background-color: #f8f8f8;
-                border: 1px solid #cccccc;
-                border-radius: 3px;
-                color: #000000;
-                font-size: 26px;
-                font-weight: bold;
-                padding: 2px;
-                min-height: 30px;
-                text-align: center;           
-            }
-            QPushButton#relate-preview {
-                background-color: #f8f8f8;
-                border: 1px solid #cccccc;
-                border-radius: 3px;
-                color: #333333;
-                font-size: 20px;           /* 字体从20px减少到16px */
-                text-align: left;
-                padding-top: 1px;          /* padding减少 */
-                padding-left: 2px;
-            }
-            QPushButton#function-button {
-                background-color: #e0e0e0;
-                border: 1px solid #cccccc;
-                border-radius: 3px;
-                color: #000000;
-                min-height: 32px;          /* 高度从40px减少到32px */
-                font-size: 16px;           /* 字体从20px减少到16px */
-                padding: 3px;
-            }
-            QPushButton:hover {
-                background-color: #e0e0e0;
-                border-color: #999999;
-            }
-            QPushButton:pressed {
-                background-color: #d0d0d0;
-                border-color: #666666;
-            }            
-            QLabel {
-                color: #000000;
-                font-size: 26px;
-                text-align: center;
-                padding: 1px;
-                background-color: transparent;
-            }
-        """)
+        # 紧凑的白底主题样式: 只解析一次，尺寸和字体由 apply_scale 直接设置
+        self.setStyleSheet(BASE_STYLE_SHEET)
 
         # 紧凑布局 - 减少margins和spacing
         main_layout = QVBoxLayout()
@@ -610,23 +2197,43 @@ class Q9InputMethodUI(QWidget):
 
         main_layout.addLayout(function_layout)
         self.setLayout(main_layout)
+
+        # 缩放: resize 事件合并到每帧一次，只更新字体和固定尺寸，不重新解析样式表
+        self.role_fonts = {}
+        self.applied_scale_width = None
+        self.last_scale_ms = 0.0
+        self.resize_timer = QTimer(self)
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.setInterval(16)
+        self.resize_timer.timeout.connect(self.apply_pending_resize)
+        self.apply_scale(self.initial_width)
         self.set_button_img(0)       
 
     def on_grid_right_click(self, pos):
         """Handle right-click on grid_frame"""
-        print(f"Right-click detected at position: {pos}")
+        ui_log.debug("Right-click detected at position: %s", pos)
         # Example: Show a context menu
         menu = QMenu(self)
         if self.sc_output == False:
             menu.addAction("輸出簡體", self.tcsc_output)
         else:menu.addAction("輸出繁體", self.tcsc_output)
+        menu.addSeparator()
+        menu.addAction("停用延遲統計" if self.tracer.enabled else "啟用延遲統計", self.toggle_latency_trace)
+        menu.addAction("輸出延遲報告", self.dump_latency_report)
+        menu.addSeparator()
+        menu.addAction("反查編碼", self.prompt_reverse_lookup)
         #menu.addAction("Custom Action", lambda: print("Custom action triggered"))
         menu.exec_(self.grid_frame.mapToGlobal(pos))
     def resizeEvent(self, event):
+        # 拖动窗口边缘会连续产生 resize 事件，只记录并在下一帧统一处理
+        super().resizeEvent(event)
+        if not self.resize_timer.isActive():
+            self.resize_timer.start()
+
+    def apply_pending_resize(self):
         # 取得新視窗大小
-        new_size = event.size()
-        new_width = new_size.width()
-        new_height = new_size.height()
+        new_width = self.width()
+        new_height = self.height()
 
         # 根據長寬比例調整大小，以寬度為基準
         if new_width / new_height > self.aspect_ratio:
@@ -634,114 +2241,87 @@ class Q9InputMethodUI(QWidget):
         else:
             new_height = int(new_width / self.aspect_ratio)
 
-        # 重新設定視窗大小
-        self.resize(new_width, new_height)
+        # 重新設定視窗大小 (產生的 resize 事件會再合併一次，尺寸不變時不再調整)
+        if (new_width, new_height) != (self.width(), self.height()):
+            self.resize(new_width, new_height)
 
-        # 根據新的寬度來更新樣式
-        self.update_style_for_size(new_width)
-    def update_style_for_size(self, current_width):
+        # 根據新的寬度來更新字體和尺寸
+        self.apply_scale(new_width)
+
+    def apply_scale(self, current_width):
+        """按宽度缩放九宫格: 直接设置字体、固定尺寸和图标尺寸，并记录耗时"""
+        if current_width == self.applied_scale_width:
+            return
+        start = time.perf_counter()
+        self.applied_scale_width = current_width
         scale_factor = current_width / self.initial_width
         
         # 紧凑模式的尺寸计算
-        button_size = 80 * scale_factor      # 基础尺寸从70减少到55
-        func_button_size = 32 * scale_factor # 功能按钮从30减少到25
+        button_size = int(80 * scale_factor)      # 基础尺寸从70减少到55
+        func_button_size = int(32 * scale_factor) # 功能按钮从30减少到25
         button_font_size = int(40 * scale_factor)  # 字体从30减少到26
         relate_font_size = int(15 * scale_factor)  # 字体从20减少到16
-        input_display_font_size = 26 * scale_factor
-
-        new_style = f"""
-            QWidget {{
-                background-color: #ffffff;
-                color: #000000;
-            }}
-            QPushButton {{
-                background-color: #f0f0f0;
-                border: 1px solid #cccccc;
-                border-radius: 3px;
-                color: #000000;
-                font-size: {button_font_size}px;
-                font-weight: bold;
-                padding: 2px;
-                min-height: {button_size}px;
-                min-width: {button_size}px;
-                max-height: {button_size}px;
-                max-width: {button_size}px;
-            }}
-            QPushButton#NumberButton {{
-                background-color: #f8f8f8;
-                border: 1px solid #cccccc;
-                border-radius: 1px;
-                color: #000000;
-                font-size: {button_font_size}px;
-                font-weight: bold;
-                padding: 2px;
-                min-height: {button_size}px;
-                min-width: {button_size}px;
-                max-height: {button_size}px;
-                max-width: {button_size}px;
-            }}
-            QPushButton:hover {{
-                background-color: #e0e0e0;
-                border-color: #999999;
-            }}
-            QPushButton:pressed {{
-                background-color: #d0d0d0;
-                border-color: #666666;
-            }}
-            QPushButton#relate-preview {{
-                background-color: #f8f8f8;
-                border: 1px solid #cccccc;
-                border-radius: 3px;
-                color: #333333;
-                font-size: {relate_font_size}px;
-                text-align: left;
-                font-weight: bold;
-                padding: 2px;               
-                min-height: {button_size}px;
-                min-width: {button_size}px;
-                max-height: {button_size}px;
-                max-width: {button_size}px;
-            }}
-            QPushButton#function-button {{
-                background-color: #e0e0e0;
-                border: 1px solid #cccccc;
-                border-radius: 3px;
-                color: #000000;
-                min-height: {func_button_size}px;
-                max-height: {func_button_size}px;
-                font-size: {relate_font_size}px;
-                padding: 3px;
-            }}
-            QLabel {{
-                color: #000000;
-                font-size: {input_display_font_size}px;
-                text-align: center;
-                padding: 1px;
-                background-color: transparent;
-            }}
-        """
-        
-        self.setStyleSheet(new_style)
 
-        # 图标尺寸也相应减小
-        icon_size = int(65 * scale_factor)  # 从80减少到65
+        self.role_fonts = {
+            "NumberButton": self.scaled_font(button_font_size),
+            "relate-preview": self.scaled_font(relate_font_size),
+            "function-button": self.scaled_font(relate_font_size),
+        }
+
+        # 与样式表 padding + border 对应的外框
+        grid_box = 2 * (GRID_BUTTON_PADDING + BUTTON_BORDER)
+        function_box = 2 * (FUNCTION_BUTTON_PADDING + BUTTON_BORDER)
+        for btn in self.grid_buttons.values():
+            btn.setFixedSize(button_size + grid_box, button_size + grid_box)
+            btn.setFont(self.role_fonts.get(btn.objectName(), self.role_fonts["NumberButton"]))
+        for btn in (self.function_0_btn, self.function_dot_btn):
+            btn.setFixedSize(button_size + function_box, func_button_size + function_box)
+            btn.setFont(self.role_fonts["function-button"])
+
+        # 图标尺寸随缩放变化，旧尺寸的缓存图标失效
+        icon_size = button_size
+        new_icon_size = QSize(icon_size, icon_size)
+        icon_size_changed = new_icon_size != self.grid_icon_size
+        if icon_size_changed:
+            self.grid_icon_size = new_icon_size
+            self.icon_cache.invalidate()
         for btn in self.grid_buttons.values():
-            btn.setIconSize(QSize(icon_size, icon_size))
+            btn.setIconSize(self.grid_icon_size)
+        if icon_size_changed:
+            # 缓存图标按旧尺寸预缩放 (QIcon 不放大)，当前画面按新尺寸重画
+            self.redraw_grid()
+
+        self.last_scale_ms = (time.perf_counter() - start) * 1000
+        ui_log.debug("缩放到宽度 %d: %.2f ms", current_width, self.last_scale_ms)
+
+    def scaled_font(self, pixel_size):
+        font = QFont(self.font())
+        font.setPixelSize(max(pixel_size, 1))
+        font.setBold(True)
+        return font
+
+    @traced("render")
+    def redraw_grid(self):
+        """按当前模式重画九宫格 (选字页、关联词预览或输入中的图像)"""
+        if self.select_mode:
+            self.show_page(self.curr_page)
+        elif self.showing_relates:
+            self.show_relate_preview(self.current_relates)
+        elif len(self.current_input) == 1:
+            self.set_button_img(int(self.current_input))
+        elif len(self.current_input) == 2:
+            self.set_button_img(10)
+        else:
+            self.set_button_img(0)
+
     def set_button_img(self, type_val):
         """根據 type 設置九宮格按鈕的圖像"""
+        cells = {}
         for i in range(1, 10):
             num = (11 if type_val == 10 else type_val) * 10 + i
-            btn = self.grid_buttons[i]
-            btn.setObjectName("NumberButton")
-            btn.setStyleSheet("")   
-            if num in self.images:
-                btn.setIcon(QIcon(self.images[num]))
-                #print(f"Png:"f"{num}")
-                btn.setIconSize(QSize(80, 80))
-                btn.setText("")
-            else:
-                btn.setText(str(i))
-                btn.setIcon(QIcon())            
+            icon = self.grid_icon(num)
+            # 有圖像時只顯示圖標，沒有時顯示數字
+            cells[i] = ("NumberButton", "" if icon is not None else str(i), icon)
             
             #btn.setStyleSheet("""
             #    QPushButton {
@@ -757,8 +2337,22 @@ class Q9InputMethodUI(QWidget):
             #    QPushButton:hover { background-color: #505050; }
             #    QPushButton:pressed { background-color: #606060; }
             #""")
+        self.grid_view.render(cells)
         self.function_0_btn.setText("標點")
 
+    def image_memory_report(self):
+        resident, full = self.images.resident_bytes()
+        target = self.images.target_size
+        return (f"images: {resident / 1024:.0f} KiB resident "
+                f"(full resolution {full / 1024:.0f} KiB), decode size "
+                f"{f'{target.width()}x{target.height()}' if target else 'source'}, "
+                f"re-decodes {self.images.redecodes}; "
+                f"icons: {len(self.icon_cache)} / {self.icon_cache.resident_bytes() / 1024:.0f} KiB")
+
+    def grid_icon(self, num, text=""):
+        """从缓存取九宫格图标，没有图像时返回 None"""
+        return self.icon_cache.icon(num, text, self.grid_icon_size, self.devicePixelRatioF())
+
     def create_grid_buttons(self):
         self.grid_buttons = {}
         positions = [(2, 0, 1), (2, 1, 2), (2, 2, 3),
@@ -769,44 +2363,163 @@ class Q9InputMethodUI(QWidget):
             btn.clicked.connect(lambda checked, n=num: self.handle_key_input(n))
             self.grid_layout.addWidget(btn, row, col)
             self.grid_buttons[num] = btn
+        # 狀態切換只更新有變化的按鈕屬性
+        self.grid_view = GridView(self.grid_buttons, lambda: self.role_fonts)
 
     def init_database(self):
+        self.dataset, self.code_index, self.ts_converter = self.build_dictionary()
+        self.phrase_index, self.reverse_index = self.build_derived_indexes(self.code_index)
+        # 字典文件更新後在後台重建並替換，不需要重啟
+        self.dictionary_reloading = False
+        self.dictionary_reload_again = False
+        self.dictionary_watcher = DictionaryWatcher([self.db_path, compiled_path(self.db_path)], parent=self)
+        self.dictionary_watcher.changed.connect(self.reload_dictionary)
+        self.dictionary_reloaded.connect(self.swap_dictionary, Qt.QueuedConnection)
+
+    def build_dictionary(self):
+        """打開字典並開始後台載入，返回 (dataset, code_index, ts_converter)"""
+        compiled = open_compiled_dictionary(self.db_path)
+        if compiled is not None:
+            # 編譯字典 mmap 共享，啟動不打開 SQLite
+            db_log.info("編譯字典: %s", compiled.path)
+            return None, CodeIndex(None, compiled).start(), TSConverter(None, compiled).start()
         if os.path.exists(self.db_path):
-            self.db_connection = sqlite3.connect(self.db_path)
-            print(f"數據庫連接成功: {self.db_path}")
-        else:
-            print(f"數據庫文件不存在: {self.db_path}")
+            db_log.info("數據庫: %s", self.db_path)
+            dataset = DatasetDB(self.db_path)
+            dataset.warn_missing_indexes()
+            dataset.close_connection()
+            # 編碼表和繁簡表在後台載入內存，載入完成前按鍵走參數化點查詢
+            return dataset, CodeIndex(dataset).start(), TSConverter(dataset).start()
+        db_log.warning("數據庫文件不存在: %s", self.db_path)
+        return None, None, None
+
+    @staticmethod
+    def build_derived_indexes(code_index):
+        """在後台從 CodeIndex 建立詞組前綴樹和反查索引，返回 (phrase_index, reverse_index)"""
+        if not code_index:
+            return None, None
+        return PhraseIndex(code_index).start(), ReverseIndex(code_index).start()
+
+    def dataset_report(self):
+        return self.dataset.report() if self.dataset else ""
+
+    def phrase_report(self):
+        return self.phrase_index.report() if self.phrase_index else ""
+
+    def reload_dictionary(self):
+        if self.dictionary_reloading:
+            self.dictionary_reload_again = True
+            return
+        self.dictionary_reloading = True
+        db_log.info("字典文件已更新，後台重建索引")
+        threading.Thread(target=self.rebuild_dictionary, daemon=True).start()
 
-    def sql_to_character_array(self, sql_statement):
+    def rebuild_dictionary(self):
+        """後台線程: 完整建好新索引後才交給 GUI 線程替換"""
         try:
-            cursor = self.db_connection.cursor()
-            cursor.execute(sql_statement)
-            result = cursor.fetchone()
-            if result and result[0]:
-                return list(result[0])
-            return None
+            # 先記錄文件狀態: 載入期間若再被改寫，監視器會再觸發一次
+            signature = self.dictionary_watcher.signature()
+            dataset, code_index, ts_converter = self.build_dictionary()
+            phrase_index, reverse_index = self.build_derived_indexes(code_index)
+            indexes = [index for index in (code_index, ts_converter, phrase_index, reverse_index)
+                       if index is not None]
+            for index in indexes:
+                index.wait()
+            # 任一索引出錯或編碼表為空 (表被刪、寫到一半、結構損壞) 都保留原來的字典
+            ok = (code_index is not None and len(code_index.codes) > 0
+                  and all(index.load_seconds is not None and not index.failed for index in indexes))
         except Exception as e:
-            print(f"SQL查詢錯誤: {e}")
-            return None
+            db_log.error("字典重建失敗: %s", e)
+            signature, dataset, code_index, ts_converter, phrase_index, reverse_index = (None,) * 6
+            ok = False
+        self.dictionary_reloaded.emit((ok, signature, dataset, code_index, ts_converter, phrase_index, reverse_index))
+
+    def swap_dictionary(self, result):
+        """GUI 線程 (兩次按鍵之間): 一次替換全部索引引用，舊索引保持完整直到不再被引用"""
+        ok, signature, dataset, code_index, ts_converter, phrase_index, reverse_index = result
+        self.dictionary_reloading = False
+        if ok:
+            old_dataset = self.dataset
+            self.dataset, self.code_index, self.ts_converter = dataset, code_index, ts_converter
+            self.phrase_index, self.reverse_index = phrase_index, reverse_index
+            self.phrase_prefix, self.phrase_node = "", None
+            self.dictionary_watcher.mark_loaded(signature)
+            # 預取和關聯詞預渲染用的是舊字典
+            self.prefetcher.cancel()
+            self.relate_prerender_timer.stop()
+            self.relate_prerenderer.cancel()
+            self.prerendered_relates = {}
+            if old_dataset is not None:
+                old_dataset.close_connection()
+            db_log.info("字典已重新載入")
+        else:
+            db_log.warning("字典重建未完成，繼續使用原來的索引")
+        if self.dictionary_reload_again:
+            self.dictionary_reload_again = False
+            self.reload_dictionary()
 
+    @traced("lookup")
     def key_input(self, key):
-        """根據 key 查詢字符"""
-        print(f"查詢字符: {key}")
-        return self.sql_to_character_array(f"SELECT characters FROM mapped_table WHERE id='{key}'")
+        """根據 key 查詢字符 (內存索引, 未載入完成時等待)"""
+        db_log.debug("查詢字符: %s", key)
+        if not self.code_index:
+            return None
+        return self.code_index.lookup_code(key)
 
+    @traced("lookup")
     def get_relate(self, word):
-        if not self.db_connection:
-            return None
-        try:
-            cursor = self.db_connection.cursor()
-            cursor.execute(f"SELECT candidates FROM related_candidates_table WHERE character='{word}'")
-            result = cursor.fetchone()
-            if result and result[0]:
-                return [w.strip() for w in result[0].split(" ") if w.strip()]
-            return None
-        except Exception as e:
-            print(f"關聯詞查詢錯誤: {e}")
+        if not self.code_index:
             return None
+        return self.code_index.lookup_relates(word)
+
+    @traced("lookup")
+    def reverse_lookup(self, text):
+        """反查: 單字返回 [ReverseHit(編碼, 頁, 位)]；詞返回 [ReverseHit(首字, 頁, 位)]，不在關聯詞表中為 []"""
+        index = self.reverse_index
+        if index is None or not text:
+            return []
+        # 索引在啟動時已開始後台建立，只有剛啟動就查詢時才需等待
+        if len(text) == 1:
+            return [self.displayed_hit(hit, hit.key, index.code_index.lookup_code(hit.key), text)
+                    for hit in index.lookup_char(text)]
+        hit = index.lookup_phrase(text)
+        if hit is None:
+            return []
+        return [self.displayed_hit(hit, "r:" + hit.key, index.code_index.lookup_relates(hit.key), text[1:])]
+
+    def displayed_hit(self, hit, context, words, word):
+        """把字典順序的頁/位換成選字頻率排序後實際顯示的頁/位"""
+        if self.usage_store is None or not words:
+            return hit
+        words = self.ranked(context, words)
+        if word not in words:
+            return hit
+        position = words.index(word)
+        return hit._replace(page=position // 9 + 1, slot=position % 9 + 1)
+
+    def describe_reverse_lookup(self, text):
+        lines = []
+        if len(text) > 1:
+            hits = self.reverse_lookup(text)
+            if hits:
+                char, page, slot = hits[0]
+                codes = "、".join(hit.key for hit in self.reverse_lookup(char)) or "無"
+                lines.append(f"{text}: 先輸入「{char}」(編碼 {codes})，關聯詞第 {page} 頁第 {slot} 個")
+                return "\n".join(lines)
+            lines.append(f"{text}: 不在關聯詞表中，逐字編碼:")
+        for char in dict.fromkeys(text):
+            hits = self.reverse_lookup(char)
+            if hits:
+                lines.append(f"{char}: " + "；".join(f"{code} 第 {page} 頁第 {slot} 個" for code, page, slot in hits))
+            else:
+                lines.append(f"{char}: 無編碼")
+        return "\n".join(lines)
+
+    def prompt_reverse_lookup(self):
+        text, ok = QInputDialog.getText(self, "反查編碼", "輸入字或詞:")
+        text = text.strip()
+        if ok and text:
+            QMessageBox.information(self, "反查編碼", self.describe_reverse_lookup(text))
     def create_text_overlay_with_background(self, base_image, text, font_size=16):
         """创建带背景色的文字覆盖（更好的可读性）"""
         if base_image.isNull():
@@ -848,29 +2561,15 @@ class Q9InputMethodUI(QWidget):
         result_pixmap.fill(Qt.transparent)
         
         painter = QPainter(result_pixmap)
-        painter.setRenderHint(QPainter.Antialiasing)
-        
         # 绘制原始图像
         painter.drawPixmap(0, 0, base_image)
-        
-        # 设置字体
-        font = QFont("Arial", font_size, QFont.Bold)
-        painter.setFont(font)
-        
-        # 黑色文字，适合白底主题
-        painter.setPen(QPen(QColor(0, 0, 0), 2))  # 黑色文字
-        
-        # 文字区域 - 左上角
-        text_rect = result_pixmap.rect()
-        text_rect.setRight(text_rect.width() // 2)    # 左半部
-        text_rect.setBottom(text_rect.height() // 2)  # 上半部
-        
-        # 绘制文字
-        painter.drawText(text_rect, Qt.AlignTop | Qt.AlignLeft, text)
-        
         painter.end()
+
+        # 黑色文字，左上角，适合白底主题
+        draw_overlay_text(result_pixmap, text, font_size)
         return result_pixmap
 
+    @traced("render")
     def show_relate_preview(self, relates):
         """显示关联词预览，白底主题版本"""
         self.current_relates = relates
@@ -881,44 +2580,18 @@ class Q9InputMethodUI(QWidget):
         self.curr_page = 0
         self.total_page = 0
         
+        cells = {}
         for i in range(1, 10):
-            btn = self.grid_buttons[i]
-            
-            if i-1 < len(relates) and relates[i-1] and relates[i-1] != "*":
-                # 有关联词的情况
-                num = 100 + i
-                if num in self.images:
-                    # 创建带有黑色文字的复合图像
-                    base_image = self.images[num]
-                    composite_image = self.create_text_overlay_image(
-                        base_image, 
-                        relates[i-1], 
-                        font_size=45
-                    )
-                    btn.setIcon(QIcon(composite_image))
-                    btn.setIconSize(QSize(80, 80))
-                    btn.setText("")
-                else:
-                    # 没有对应图像，使用按钮文字
-                    btn.setText(relates[i-1])
-                    btn.setIcon(QIcon())
-                
-                btn.setObjectName("relate-preview")
+            num = 100 + i
+            # 有关联词时叠加黑色文字 (缓存)，空白时只用半透明图像
+            text = relates[i-1] if i-1 < len(relates) and relates[i-1] and relates[i-1] != "*" else ""
+            icon = self.grid_icon(num, text)
+            if icon is not None:
+                cells[i] = ("relate-preview", "", icon)
             else:
-                # 空白情况
-                num = 100 + i
-                if num in self.images:
-                    btn.setText("")
-                    btn.setIcon(QIcon(self.images[num]))
-                    btn.setIconSize(QSize(80, 80))
-                else:
-                    btn.setText("")
-                    btn.setIcon(QIcon())
-                
-                btn.setObjectName("relate-preview")
-            
-            btn.setStyleSheet("")  # 使用默认样式
-            btn.update()
+                # 没有对应图像，使用按钮文字
+                cells[i] = ("relate-preview", text, None)
+        self.grid_view.render(cells)
         
         self.function_0_btn.setText("選字" if relates else "標點")
         self.function_dot_btn.setText("取消")
@@ -926,9 +2599,9 @@ class Q9InputMethodUI(QWidget):
     def show_page_list(self, words):
         for i in range(1, 10):
             if i <= len(words):
-                self.grid_buttons[i].setText(words[i - 1])
+                self.grid_view.set_text(i, words[i - 1])
             else:
-                self.grid_buttons[i].setText(str(i))
+                self.grid_view.set_text(i, str(i))
 
     def handle_key_input(self, key):
 
@@ -941,8 +2614,11 @@ class Q9InputMethodUI(QWidget):
         if self.is_hidden:
             return
         """統一處理所有輸入"""
+        if self.commit_buffer.pending and not self.is_relate_keystroke(key):
+            self.flush_output()
         if key == ".":
             self.reset_input()
+            self.phrase_prefix, self.phrase_node = "", None  # 取消時結束詞組
             return
 
         try:
@@ -959,7 +2635,7 @@ class Q9InputMethodUI(QWidget):
                 if 0 <= page_index < len(self.select_words):
                     selected_char = self.select_words[page_index]
                     if not isinstance(selected_char, str):
-                        print(f"[調試] select_word(): 非 str 類型，自動轉換: {type(selected_char)}")
+                        ui_log.debug("select_word(): 非 str 類型，自動轉換: %s", type(selected_char))
                         selected_char = str(selected_char)
                     self.select_word(selected_char)
             return
@@ -967,28 +2643,31 @@ class Q9InputMethodUI(QWidget):
         # === 關聯詞預覽模式 ===
         if self.showing_relates:
             if num == 0:
-                self.start_select_word(self.current_relates)
+                self.start_select_word(self.current_relates, self.relate_context)
                 return
             elif key == ".":
                 self.reset_input()
                 return
             else:
-                print("不關聯詞輸入")
+                ui_log.debug("不關聯詞輸入")
                 self.reset_input()
                        
             
 
         # === 輸入模式 ===
+        if not self.current_input:
+            # 打新的編碼: 不再接續之前的詞組
+            self.phrase_prefix, self.phrase_node = "", None
         self.current_input += str(num)
-        print("Output: " + f"{self.current_input}")  
+        ui_log.debug("Output: %s", self.current_input)
         #self.input_display.setText(self.current_input)
 
         # 單獨處理 0、10、20...90 立即查詢
         if self.current_input in ["0", "10", "20", "30", "40", "50", "60", "70", "80", "90"]:
-            chars = self.key_input(self.current_input)
-            if chars:
-                print(f"[調試] DB 查詢 {self.current_input} → {chars}")
-                self.start_select_word(chars)
+            page = self.candidates_for(self.current_input)
+            if page:
+                db_log.debug("DB 查詢 %s → %s", self.current_input, page.words)
+                self.start_select_word(page.words, self.current_input, page.first_page)
             else:
                 #self.status_label.setText(f"未找到 {self.current_input} 對應的字符")
                 self.reset_input()
@@ -996,139 +2675,259 @@ class Q9InputMethodUI(QWidget):
 
         # 普通三位數輸入完成
         if len(self.current_input) == 3:
-            chars = self.key_input(self.current_input)
-            if chars:
-                print(f"[調試] DB 查詢 {self.current_input} → {chars}")
-                self.start_select_word(chars)
+            page = self.candidates_for(self.current_input)
+            if page:
+                db_log.debug("DB 查詢 %s → %s", self.current_input, page.words)
+                self.start_select_word(page.words, self.current_input, page.first_page)
             else:
                 #self.status_label.setText(f"未找到 {self.current_input} 對應的字符")
                 self.reset_input()
         elif len(self.current_input) == 1:
             self.set_button_img(num)
+            self.prefetcher.speculate(self.current_input)
         elif len(self.current_input) == 2:
             self.set_button_img(10)
+            self.prefetcher.speculate(self.current_input)
+
+    def is_relate_keystroke(self, key):
+        """關聯詞預覽中按 0 進入關聯詞選擇，或在關聯詞列表中翻頁/選擇"""
+        key = str(key)
+        if self.select_mode:
+            return (self.select_context or "").startswith(("r:", "p:")) and key != "."
+        return self.showing_relates and key == "0"
 
     def output_character(self, char):
         """输出字符 - 使用跨平台方法"""
         self.output_character_cross_platform(char)
-    def start_select_word(self, words):
+    def ranked(self, context, words):
+        """按使用頻率重排候選 (context: 編碼或 "r:" + 前字)"""
+        if self.usage_store is None:
+            return words
+        return self.usage_store.reorder(context, words)
+
+    def prepare_candidates(self, code):
+        """查詢並排序一個完整編碼的候選，同時算好首頁文字 (可在後台線程調用)"""
+        chars = self.key_input(code)
+        if not chars:
+            return None
+        words = self.ranked(code, chars)
+        return PrefetchedPage(words, self.page_texts(words, 0))
+
+    def candidates_for(self, code):
+        """完整編碼的候選頁，優先取預取結果"""
+        page = self.prefetcher.take(code)
+        if page is CandidatePrefetcher.MISSING:
+            self.tracer.count("prefetch_miss")
+            return self.prepare_candidates(code)
+        self.tracer.count("prefetch_hit")
+        return page
+
+    def start_select_word(self, words, context=None, first_page=None):
         if not isinstance(words, (list, tuple)):
-            print(f"[調試] start_select_word() 參數非列表，類型: {type(words)}")
+            ui_log.debug("start_select_word() 參數非列表，類型: %s", type(words))
             return
         if not words:
-            print("[調試] start_select_word() 收到空列表")
+            ui_log.debug("start_select_word() 收到空列表")
             return
         self.select_words = words
+        self.select_context = context
         self.total_page = (len(words) + 8) // 9
         self.select_mode = True
         self.current_input = ""
         self.current_page = "select"
-        self.show_page(0)
+        self.show_page(0, first_page)
         self.function_0_btn.setText("下頁")
 
     def select_word(self, selected_char):
         """選擇字符，保留關聯功能"""
         if not isinstance(selected_char, str):
-            print(f"[調試] select_word(): 非 str 類型，自動轉換: {type(selected_char)}")
+            ui_log.debug("select_word(): 非 str 類型，自動轉換: %s", type(selected_char))
             selected_char = str(selected_char)
         self.output_character(selected_char)
+        if self.usage_store is not None and self.select_context:
+            self.usage_store.record(self.select_context, selected_char)
+        completions = self.advance_phrase(self.committed_prefix(selected_char)) or []
         if len(selected_char) == 1:
             self.last_word = selected_char
-            relates = self.get_relate(selected_char)
-            if relates:
-                self.show_relate_preview(relates)
+            self.relate_context = "r:" + selected_char
+            relates = self.prerendered_relates.get(selected_char, CandidatePrefetcher.MISSING)
+            if relates is CandidatePrefetcher.MISSING:
+                self.tracer.count("relate_prerender_miss")
+                relates = self.ranked("r:" + selected_char, self.get_relate(selected_char))
             else:
-                self.reset_input()
+                self.tracer.count("relate_prerender_hit")
         else:
             self.last_word = ""
+            relates = []
+        if completions:
+            # 已提交的字可以接成更長的詞組: 補全排在這個字自己的關聯詞前面
+            self.last_word = self.phrase_prefix[-1]
+            if not relates:
+                self.relate_context = "p:" + self.phrase_prefix
+            seen = set(completions)
+            relates = completions + [word for word in relates if word not in seen]
+        if relates:
+            self.show_relate_preview(relates)
+            self.commit_buffer.hold()
+        else:
             self.reset_input()
 
-    def show_page(self, show_page_num):
+    def committed_prefix(self, selected):
+        """提交 selected 後連續輸入的詞組前綴"""
+        context = self.select_context or ""
+        if context.startswith("p:"):
+            return context[2:] + selected
+        if context.startswith("r:"):
+            char = context[2:]
+            if self.phrase_prefix.endswith(char):
+                return self.phrase_prefix + selected
+            return char + selected
+        return self.phrase_prefix + selected
+
+    @traced("lookup")
+    def advance_phrase(self, prefix):
+        """把詞組前綴推進到 prefix (只在上一區間內二分)，返回排序後的補全後綴；沒有補全返回 None
+
+        沒有詞組以 prefix 開頭時從最後一個字重新開始。
+        """
+        index = self.phrase_index
+        if index is None or not index.is_ready():
+            self.phrase_prefix, self.phrase_node = prefix[-1:], None
+            return None
+        start = index.root
+        if self.phrase_node is not None and self.phrase_prefix and prefix.startswith(self.phrase_prefix):
+            start = self.phrase_node
+        node = index.narrow(start, prefix)
+        if node[0] == node[1]:
+            prefix = prefix[-1:]
+            node = index.narrow(index.root, prefix)
+        self.phrase_prefix, self.phrase_node = prefix, node
+        if len(prefix) < 2 or node[0] == node[1]:
+            return None
+        completions = index.completions(node, prefix)
+        return self.ranked("p:" + prefix, completions) if completions else None
+
+    @traced("render")
+    def show_page(self, show_page_num, texts=None):
         self.curr_page = show_page_num
-        for i in range(1, 10):
-            page_index = self.curr_page * 9 + i - 1
-            btn = self.grid_buttons[i]
-            
-            # 移除硬编码的样式，让按钮使用全局白底主题样式
-            btn.setObjectName("NumberButton")  # 设置为数字按钮样式
-            btn.setStyleSheet("")  # 清除内联样式，使用全局样式表
-            btn.setIcon(QIcon())   # 清除图标
-            
-            if page_index >= len(self.select_words):
-                btn.setText("")
-            else:
-                word = self.select_words[page_index]
-                btn.setText(word if word and word != "*" else "")
+        if texts is None:
+            texts = self.page_texts(self.select_words, show_page_num)
+        self.prerender_relates(texts)
+        # 数字按钮样式、无图标；翻页时通常只有文字变化
+        self.grid_view.render({i: ("NumberButton", texts[i - 1], None) for i in range(1, 10)})
         page_info = f"{self.curr_page + 1}/{self.total_page}頁" if self.total_page > 1 else ""
         #self.status_label.setText(f"請選擇字符 - {page_info}")
 
+    def prerender_relates(self, texts):
+        """為當前頁的單字在後台準備關聯詞預覽，舊頁的任務作廢"""
+        self.prerendered_relates = {}
+        self.relate_prerenderer.cancel()
+        self.prerender_words = [text for text in texts if len(text) == 1]
+        self.relate_prerender_timer.start()
+
+    def start_relate_prerender(self):
+        if not self.select_mode:
+            return
+        self.prerender_size = (QSize(self.grid_icon_size), self.devicePixelRatioF())
+        self.relate_prerenderer.submit(self.prerender_words, *self.prerender_size)
+
+    def prepare_relate_preview(self, word, size, device_pixel_ratio):
+        """後台線程: 查詢排序關聯詞，合成預覽需要但緩存中還沒有的疊加圖"""
+        relates = self.ranked("r:" + word, self.get_relate(word))
+        images = {}
+        for i in range(1, 10):
+            num = 100 + i
+            text = relates[i - 1] if relates and i <= len(relates) and relates[i - 1] != "*" else ""
+            if num not in self.images:
+                continue
+            if (num, text, size.width(), size.height()) in self.icon_cache:
+                continue
+            self.images.reserve(size * device_pixel_ratio)
+            images[(num, text)] = render_overlay_icon_image(
+                self.images.image(num), text, RELATE_FONT_SIZE * self.images.scale_of(num), size, device_pixel_ratio)
+        return relates, images
+
+    def on_relate_prerendered(self, generation, word, relates, images):
+        if generation != self.relate_prerenderer.generation:
+            return
+        self.prerendered_relates[word] = relates
+        # 期間窗口縮放過則圖像作廢，顯示時再同步生成
+        size, device_pixel_ratio = self.prerender_size
+        if size != self.grid_icon_size or device_pixel_ratio != self.devicePixelRatioF():
+            return
+        for (num, text), image in images.items():
+            self.icon_cache.put(num, text, size, image, device_pixel_ratio)
+
+    @staticmethod
+    def page_texts(words, page_num):
+        """某一頁九個按鈕的文字，空位和 "*" 顯示為空"""
+        page = words[page_num * 9:page_num * 9 + 9]
+        return [word if word and word != "*" else "" for word in page] + [""] * (9 - len(page))
+
     def add_page(self, add_num):
         new_page = (self.curr_page + add_num) % self.total_page
         self.show_page(new_page)
 
     def tcsc(self, input_char):
         """Convert traditional Chinese to simplified Chinese using ts_chinese_table"""
-        if not self.db_connection:
-            print("Database connection not initialized")
+        if not self.ts_converter:
+            db_log.warning("繁簡轉換表未載入")
             return input_char
-        
-        output = ""
-        for c in input_char:
-            try:
-                cursor = self.db_connection.cursor()
-                query = f"SELECT simplified FROM ts_chinese_table WHERE traditional='{c}' LIMIT 1"
-                cursor.execute(query)
-                result = cursor.fetchone()
-                if result and result[0]:
-                    output += result[0]
-                else:
-                    output += c
-            except Exception as e:
-                print(f"Error converting character '{c}': {e}")
-                output += c
-        return output
+        return self.ts_converter.convert(input_char)
+
     def tcsc_output(self):
         """Toggle between simplified and traditional Chinese output"""
+        # 切换前先输出已提交的文字，不与新模式的文字混在一批
+        self.flush_output()
         self.sc_output = not self.sc_output
-        print(f"Output mode: {'Simplified' if self.sc_output else 'Traditional'} Chinese")
+        output_log.info("Output mode: %s Chinese", "Simplified" if self.sc_output else "Traditional")
         self.set_button_img(0)  # Reset button images
         
-    def output_character_cross_platform(self, char):
-        """跨平台字符输出"""
-        output_char = self.tcsc(char) if self.sc_output else char
-        print(f"输出字符: {output_char}")
-        
-        # 根据操作系统选择输出方法
+    def create_output_backend(self):
+        """选择常驻输出后端，提交时不再每个字符启动进程"""
+        backend = None
         try:
             if self.current_os == "Linux":
-                # Linux 先复制到剪贴板再粘贴
-                clipboard = self.app.clipboard()
-                clipboard.setText(output_char)
-                print(f"已复制到剪贴板: {output_char}")
-                subprocess.run(["xdotool", "key", "ctrl+v"], check=True)
-                print(f"Linux: 已模拟粘贴: {output_char}")
-            elif self.current_os == "Windows":
-                # Windows 直接使用 pynput 输出字符
-                if WINDOWS_PYNPUT_AVAILABLE:
-                    # 创建键盘控制器
-                    kb = keyboard.Controller()
-                    # 直接输入字符，无需剪贴板
-                    kb.type(output_char)
-                    print(f"Windows: 已直接输入: {output_char}")
+                fallback = XdotoolPasteBackend(self.app) if shutil.which("xdotool") else None
+                if self.linux_hook_active():
+                    # 每次注入时才取虚拟键盘，运行中加入的键盘也能使用
+                    backend = UInputPasteBackend(self.app, self.paste_keyboards, self.uinput_lock, fallback)
                 else:
-                    # 回退到剪贴板方法
-                    clipboard = self.app.clipboard()
-                    clipboard.setText(output_char)
-                    print("Windows: pynput 不可用，已复制到剪贴板，请手动粘贴")
+                    backend = fallback
+            elif self.current_os == "Windows" and WINDOWS_PYNPUT_AVAILABLE:
+                backend = PynputTypeBackend(self.app)
         except Exception as e:
-            print(f"字符输出失败: {e}", file=sys.stderr)
+            output_log.error("输出后端初始化失败: %s", e)
+        if backend is None:
+            backend = ClipboardOutputBackend(self.app)
+        output_log.info("输出后端: %s", backend.name)
+        return backend
+
+    def output_character_cross_platform(self, char):
+        """跨平台字符输出: 先进提交缓冲，到期或下一个非关联按键时合并注入"""
+        output_char = self.tcsc(char) if self.sc_output else char
+        output_log.debug("输出字符: %s", output_char)
+        self.commit_buffer.append(output_char)
+
+    def flush_output(self):
+        """立即注入缓冲中的全部文字 (按提交顺序)"""
+        self.commit_buffer.flush()
+
+    @traced("output")
+    def inject_text(self, text):
+        """把合并后的文字一次注入目标程序"""
+        try:
+            self.output_backend.inject(text)
+            output_log.debug("%s: 已输出: %s", self.output_backend.name, text)
+        except Exception as e:
+            output_log.error("字符输出失败: %s", e)
             # 失败时回退到剪贴板
             try:
                 clipboard = self.app.clipboard()
-                clipboard.setText(output_char)
-                print(f"回退: 已复制到剪贴板: {output_char}")
+                clipboard.setText(text)
+                output_log.info("回退: 已复制到剪贴板: %s", text)
             except Exception as e2:
-                print(f"剪贴板操作也失败: {e2}", file=sys.stderr)
+                output_log.error("剪贴板操作也失败: %s", e2)
 
     def reset_input(self, clean_relate=True):
         self.current_input = ""
@@ -1138,6 +2937,11 @@ class Q9InputMethodUI(QWidget):
         self.curr_page = 0
         self.total_page = 0
         self.select_mode = False
+        self.select_context = None
+        self.prefetcher.cancel()
+        self.relate_prerender_timer.stop()
+        self.relate_prerenderer.cancel()
+        self.prerendered_relates = {}
         self.last_word = ""
         self.current_relates = []
         self.showing_relates = False
@@ -1148,81 +2952,320 @@ class Q9InputMethodUI(QWidget):
         self.function_0_btn.setText("標點")
         self.function_dot_btn.setText("取消")
 
+INSTANCE_COMMANDS = ("toggle", "show", "hide", "quit")
+
+def instance_server_name():
+    """每個用戶、每個顯示一個常駐實例 (多座席主機上互不干擾)
+
+    Unix 上 socket 放在 $XDG_RUNTIME_DIR (Qt 檢查屬主與 0700 權限)，不用公共的 /tmp，
+    以免其他用戶預先佔用同名 socket；Windows 上是命名管道，直接用名字。
+    """
+    display = os.environ.get("WAYLAND_DISPLAY") or os.environ.get("DISPLAY") or ""
+    name = "q9-ime-" + re.sub(r"[^A-Za-z0-9_.-]", "_", f"{getpass.getuser()}-{display}")
+    if current_os == "Windows":
+        return name
+    runtime_dir = QStandardPaths.writableLocation(QStandardPaths.RuntimeLocation)
+    if not runtime_dir:
+        # 運行時目錄不可用 (屬主不對等)，退回用戶自己的緩存目錄
+        runtime_dir = image_cache_dir()
+        os.makedirs(runtime_dir, mode=0o700, exist_ok=True)
+    return os.path.join(runtime_dir, name)
+
+def send_instance_command(command, name=None, timeout_ms=300):
+    """把命令交給正在運行的常駐實例；沒有實例應答時返回 False (調用前須已創建 QApplication)"""
+    client = QLocalSocket()
+    client.connectToServer(name or instance_server_name())
+    if not client.waitForConnected(timeout_ms):
+        return False
+    client.write((command + "\n").encode("utf-8"))
+    sent = client.waitForBytesWritten(timeout_ms)
+    client.disconnectFromServer()
+    return sent
+
+class InstanceServer(QObject):
+    """常駐實例的本地 socket 服務端，每行文字是一條命令"""
+    command_received = pyqtSignal(str)
+
+    def __init__(self, name=None, parent=None):
+        super().__init__(parent)
+        self.name = name or instance_server_name()
+        self.server = QLocalServer(self)
+        self.server.newConnection.connect(self._accept)
+
+    def listen(self):
+        # 調用前已確認沒有實例應答，殘留的 socket 文件 (上次異常退出) 可以刪除
+        QLocalServer.removeServer(self.name)
+        self.server.setSocketOptions(QLocalServer.UserAccessOption)
+        if not self.server.listen(self.name):
+            log.warning("常駐實例監聽失敗 (%s): %s", self.name, self.server.errorString())
+            return False
+        log.info("常駐實例監聽: %s", self.server.fullServerName())
+        return True
+
+    def _accept(self):
+        while self.server.hasPendingConnections():
+            connection = self.server.nextPendingConnection()
+            connection.readyRead.connect(lambda c=connection: self._read(c))
+            connection.disconnected.connect(lambda c=connection: self._finish(c))
+
+    def _read(self, connection):
+        while connection.canReadLine():
+            command = bytes(connection.readLine()).decode("utf-8", "replace").strip()
+            if command:
+                self.command_received.emit(command)
+
+    def _finish(self, connection):
+        self._read(connection)
+        connection.deleteLater()
+
+    def close(self):
+        self.server.close()
+
 def check_windows_dependencies():
     """檢查 Windows 依賴"""
     if platform.system() == "Windows":
         try:
             import pynput
-            print("✓ Windows 依賴檢查通過")
+            log.info("✓ Windows 依賴檢查通過")
             return True
         except ImportError:
-            print("✗ Windows 缺少依賴")
-            print("請運行以下命令安裝:")
-            print("pip install pynput")
+            log.error("✗ Windows 缺少依賴")
+            log.error("請運行以下命令安裝:")
+            log.error("pip install pynput")
             return False
     return True
 
 
+InputDeviceInfo = namedtuple("InputDeviceInfo", "path name stable_id")
+
+INPUT_DIR = "/dev/input"
+STABLE_LINK_DIRS = ("by-id", "by-path")
+
+def device_config_path():
+    config_home = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    return os.path.join(config_home, "q9", "devices.json")
+
+def load_device_choice():
+    """上次選擇的設備穩定 ID 列表"""
+    try:
+        with open(device_config_path(), encoding="utf-8") as f:
+            return [device_id for device_id in json.load(f).get("devices", []) if isinstance(device_id, str)]
+    except (OSError, ValueError, AttributeError):
+        return []
+
+def save_device_choice(device_ids):
+    path = device_config_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"devices": device_ids}, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        hook_log.warning("無法保存設備選擇: %s", e)
+
+def stable_links():
+    """/dev/input/eventN 的真實路徑 -> 穩定 ID ("by-id/<鏈接名>"，沒有時用 "by-path/<鏈接名>")"""
+    links = {}
+    for link_dir in reversed(STABLE_LINK_DIRS):  # by-id 優先，後寫入覆蓋
+        directory = os.path.join(INPUT_DIR, link_dir)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        for name in names:
+            links[os.path.realpath(os.path.join(directory, name))] = f"{link_dir}/{name}"
+    return links
+
+def resolve_device_id(device_id):
+    """穩定 ID -> 可打開的設備路徑；設備不在時返回 None (不需要打開任何設備)"""
+    path = os.path.join(INPUT_DIR, device_id)
+    return path if os.path.exists(path) else None
+
+def probe_input_device(path, links):
+    """只保留能輸出 KEY_KP0–KEY_KP9 的設備"""
+    try:
+        device = InputDevice(path)
+    except OSError:
+        return None
+    try:
+        keys = set(device.capabilities().get(ecodes.EV_KEY, []))
+        if not keys.issuperset(getattr(ecodes, f"KEY_KP{digit}") for digit in range(10)):
+            return None
+        stable_id = links.get(os.path.realpath(path), os.path.relpath(path, INPUT_DIR))
+        return InputDeviceInfo(resolve_device_id(stable_id) or path, device.name, stable_id)
+    except OSError:
+        return None
+    finally:
+        device.close()
+
+def probe_input_devices():
+    """並行打開所有 /dev/input/event* 並按能力過濾"""
+    try:
+        paths = sorted(os.path.join(INPUT_DIR, name) for name in os.listdir(INPUT_DIR) if name.startswith("event"))
+    except OSError:
+        hook_log.warning("未找到設備目錄。使用預設路徑。")
+        return []
+    links = stable_links()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(16, len(paths) or 1)) as pool:
+        devices = [device for device in pool.map(lambda path: probe_input_device(path, links), paths) if device]
+    hook_log.info("掃描 %d 個輸入設備，%d 個帶數字小鍵盤: %.1f ms",
+                  len(paths), len(devices), (time.perf_counter() - start) * 1000)
+    return devices
+
+class InputDeviceWatcher(QObject):
+    """用 inotify 監視 /dev/input，記錄的設備出現/消失時通知輸入法加入/釋放"""
+    IN_ATTRIB = 0x00000004
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, device_ids, input_method):
+        super().__init__(input_method)
+        self.device_ids = list(device_ids)
+        self.input_method = input_method
+        self.present = {device_id: resolve_device_id(device_id) for device_id in self.device_ids}
+        self.fd = -1
+        # udev 會先建設備節點再建鏈接、改權限，事件合併後再檢查
+        self.rescan_timer = QTimer(self)
+        self.rescan_timer.setSingleShot(True)
+        self.rescan_timer.setInterval(300)
+        self.rescan_timer.timeout.connect(self.rescan)
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+            if self.fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1")
+            mask = self.IN_CREATE | self.IN_DELETE | self.IN_ATTRIB
+            for directory in (INPUT_DIR,) + tuple(os.path.join(INPUT_DIR, d) for d in STABLE_LINK_DIRS):
+                if os.path.isdir(directory):
+                    libc.inotify_add_watch(self.fd, directory.encode(), mask)
+            self.notifier = QSocketNotifier(self.fd, QSocketNotifier.Read, self)
+            self.notifier.activated.connect(self.on_inotify)
+        except (OSError, AttributeError, TypeError) as e:
+            hook_log.warning("無法監視 %s: %s", INPUT_DIR, e)
+
+    def on_inotify(self):
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        self.rescan_timer.start()
+
+    def rescan(self):
+        for device_id in self.device_ids:
+            path = resolve_device_id(device_id)
+            old_path = self.present.get(device_id)
+            if path == old_path:
+                continue
+            self.present[device_id] = path
+            if old_path:
+                hook_log.info("記錄的設備已移除: %s", device_id)
+                self.input_method.remove_input_device(old_path)
+            if path:
+                hook_log.info("記錄的設備已插入: %s", device_id)
+                self.input_method.add_input_device(path)
+
+def choose_input_devices(devices, preselect=()):
+    """多選設備對話框，返回選中的 InputDeviceInfo 列表；取消時返回空列表"""
+    from PyQt5.QtWidgets import QDialog, QDialogButtonBox, QListWidget, QAbstractItemView
+    dialog = QDialog()
+    dialog.setWindowTitle("選擇輸入設備")
+    layout = QVBoxLayout(dialog)
+    layout.addWidget(QLabel("選擇鍵盤設備 (可多選):"))
+    device_list = QListWidget()
+    device_list.setSelectionMode(QAbstractItemView.MultiSelection)
+    for device in devices:
+        device_list.addItem(f"{device.name}  ({device.stable_id})")
+    device_list.setCurrentRow(0)
+    for row, device in enumerate(devices):
+        if device.stable_id in preselect:
+            device_list.item(row).setSelected(True)
+    layout.addWidget(device_list)
+    buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+    buttons.accepted.connect(dialog.accept)
+    buttons.rejected.connect(dialog.reject)
+    layout.addWidget(buttons)
+    if dialog.exec_() != QDialog.Accepted:
+        return []
+    return [devices[device_list.row(item)] for item in device_list.selectedItems()]
+
 def main():
+    setup_logging()
+    log_platform_support()
     if not check_windows_dependencies():
         input("按回車鍵退出...")
         return
     
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description="Q9 中文輸入法")
+    parser.add_argument("--device", action="append", help="要獨佔的輸入設備路徑，可重複指定多個 (跳過選擇對話框)")
+    parser.add_argument("--choose-device", action="store_true", help="忽略上次記錄的設備，重新選擇")
+    parser.add_argument("--resident", action="store_true", default=os.environ.get("Q9_RESIDENT") == "1",
+                        help="常駐模式: 關閉窗口只隱藏，再次啟動時切換已運行實例的顯示 (也可設 Q9_RESIDENT=1)")
+    parser.add_argument("--command", choices=INSTANCE_COMMANDS, default="toggle",
+                        help="已有常駐實例時發給它的命令 (默認 toggle)")
+    args, qt_args = parser.parse_known_args()
+
+    # QLocalSocket 需要應用對象，先創建 (不顯示窗口)
+    app = QApplication(sys.argv[:1] + qt_args)
+
+    # 已有常駐實例: 只轉發命令，不再掃描設備、載入圖像字體和數據庫
+    if send_instance_command(args.command):
+        log.info("已交給常駐實例: %s", args.command)
+        return
+    if args.command in ("hide", "quit"):
+        log.warning("沒有正在運行的常駐實例，忽略命令: %s", args.command)
+        return
+
     app.setStyle("Fusion")
     
-    # 僅在 Linux 上掃描設備
-    if platform.system() == "Linux":
-        from evdev import InputDevice, list_devices
-        device_options = []
-        device_map = {}  # 映射名稱到路徑
-        
-        # 掃描 /dev/input/by-path 和 /dev/input/event* 設備
-        try:
-            # 嘗試 /dev/input/by-path
-            by_path_devices = [os.path.join('/dev/input/by-path', d) for d in os.listdir('/dev/input/by-path') if os.path.islink(os.path.join('/dev/input/by-path', d))]
-            for path in by_path_devices:
-                try:
-                    dev = InputDevice(path)
-                    name = dev.name
-                    device_options.append(name)
-                    device_map[name] = path
-                    dev.close()
-                except Exception:
-                    continue
-            
-            # 補充 /dev/input/event* 設備
-            event_devices = [f"/dev/input/{d}" for d in os.listdir('/dev/input') if d.startswith('event')]
-            for path in event_devices:
-                try:
-                    dev = InputDevice(path)
-                    name = dev.name
-                    if name not in device_map:  # 避免重複
-                        device_options.append(name)
-                        device_map[name] = path
-                    dev.close()
-                except Exception:
-                    continue
-        except FileNotFoundError:
-            print("未找到設備目錄。使用預設路徑。")
-            device_options = []
-        
-        if not device_options:
-            print("未找到輸入設備。使用預設路徑。")
-            device_path = "/dev/input/by-path/pci-0000:67:00.4-usb-0:1:1.0-event-kbd"
-        else:
-            # 顯示設備名稱選擇對話框
-            from PyQt5.QtWidgets import QInputDialog
-            device_name, ok = QInputDialog.getItem(None, "選擇輸入設備", "選擇鍵盤設備:", device_options, 0, False)
-            if not ok:
-                sys.exit(0)  # 用戶取消選擇
-            device_path = device_map[device_name]
-            print(f"選定設備: {device_name} -> {device_path}")
+    # 僅在 Linux 上選擇設備: 命令行 > 上次的選擇 (按穩定 ID) > 掃描並顯示對話框
+    device_ids = []
+    if platform.system() == "Linux" and args.device:
+        device_path = args.device
+    elif platform.system() == "Linux" and LINUX_EVDEV_AVAILABLE:
+        device_ids = [] if args.choose_device else load_device_choice()
+        resolved = {device_id: resolve_device_id(device_id) for device_id in device_ids}
+        device_path = [path for path in resolved.values() if path]
+        for device_id, path in resolved.items():
+            if path:
+                hook_log.info("使用上次選擇的設備: %s -> %s", device_id, path)
+            else:
+                hook_log.info("上次選擇的設備暫不存在，插入後自動加入: %s", device_id)
+        if not device_path:
+            # 記錄的設備都不在 (或第一次運行): 並行掃描帶數字小鍵盤的設備
+            devices = probe_input_devices()
+            if not devices:
+                hook_log.warning("未找到輸入設備。使用預設路徑。")
+                device_path = "/dev/input/by-path/pci-0000:67:00.4-usb-0:1:1.0-event-kbd"
+                device_ids = []
+            else:
+                # 顯示設備名稱選擇對話框 (可多選，例如筆記本鍵盤 + 外接小鍵盤)
+                chosen = choose_input_devices(devices, preselect=device_ids)
+                if not chosen:
+                    sys.exit(0)  # 用戶取消選擇
+                device_path = [device.path for device in chosen]
+                device_ids = [device.stable_id for device in chosen]
+                save_device_choice(device_ids)
+                for device in chosen:
+                    hook_log.info("選定設備: %s -> %s", device.name, device.path)
     else:
         # 非 Linux 系統使用預設行為
         device_path = None
 
     input_method = Q9InputMethodUI(device_path)
+    if device_ids:
+        # 記錄的設備插拔時自動加入/釋放，不需要重啟
+        input_method.device_watcher = InputDeviceWatcher(device_ids, input_method)
+    if args.resident:
+        server = InstanceServer(parent=input_method)
+        if server.listen():
+            server.command_received.connect(input_method.handle_instance_command)
+            input_method.instance_server = server
+            input_method.resident = True
+            app.setQuitOnLastWindowClosed(False)
     input_method.show()
     sys.exit(app.exec_())
 